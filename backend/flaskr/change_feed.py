@@ -0,0 +1,199 @@
+import sys
+import json
+import time
+import threading
+
+from sqlalchemy import and_, exists, func
+from sqlalchemy.orm import aliased
+
+from models import db, QuestionChange, ChangeLogWatermark
+
+OPERATIONS = ('insert', 'update', 'delete')
+
+
+class ChangeFeed:
+    """
+    An append-only log of the writes to the question bank, which lets clients and caches sync in proportion to what changed rather than to the size of the bank.
+
+    Every change gets a monotonically increasing sequence number. On Postgres the log is locked for the duration of each append, so changes become visible in sequence order and a reader can never skip a change which commits late.
+
+    The log lives on the app database. A write to the app database commits in the same transaction as its change. With sharding, a write to another shard is committed there first and recorded right after, in a second transaction: if recording fails, the write stays committed without a change, and the request fails with an error 500. Processes which sync from the log then miss it until they reload from the shards.
+
+    A background thread compacts the log every 'compaction_interval' seconds. Changes older than the retention window are reduced to the latest change of every question, and old delete tombstones are dropped. The highest dropped tombstone is stored as a watermark: a client asking for changes since an earlier sequence number may have missed a delete, so it has to resync from the full question list.
+    """
+
+    def __init__(self, app, retention=7 * 24 * 3600, compaction_interval=3600):
+        self.app = app
+        self.retention = retention
+        self.compaction_interval = compaction_interval
+
+        # An InvalidationBus which broadcasts every recorded batch, if caching across worker processes is enabled.
+        self.bus = None
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run, name='change-feed-compaction', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.compaction_interval):
+            try:
+                self.compact()
+            except:
+                print(sys.exc_info())
+
+    def record(self, changes, write=None):
+        """
+        Appends changes to the log in a single transaction on the app database, and broadcasts them on the invalidation bus.
+
+        Args:
+            changes: A list of (operation, question) tuples, where operation is 'insert', 'update' or 'delete' and question is an instance of the 'Question' class/data model.
+            write: (Optional) A function which makes the changes themselves on the app database session, so that they commit in the same transaction as their log entries.
+
+        Returns:
+            The sequence number of the last change.
+        """
+        changed_at = time.time()
+
+        try:
+            if write is not None:
+                write()
+                # Inserted questions get their ids here, before their payloads are serialized.
+                db.session.flush()
+
+            if db.session.bind.dialect.name == 'postgresql':
+                db.session.execute(
+                    'LOCK TABLE question_changes IN EXCLUSIVE MODE')
+
+            entries = []
+
+            for operation, question in changes:
+                if operation not in OPERATIONS:
+                    raise ValueError(f"Unknown change operation '{operation}'.")
+
+                payload = None if operation == 'delete' else json.dumps(
+                    question.format())
+
+                entries.append(QuestionChange(question_id=question.id, operation=operation,
+                                              category=question.category, payload=payload, changed_at=changed_at))
+
+            if len(entries) == 0:
+                db.session.commit()
+                return None
+
+            db.session.add_all(entries)
+            db.session.flush()
+
+            event = None
+
+            if self.bus is not None:
+                event = self.bus.event_for(entries)
+
+                if self.bus.transport.transactional:
+                    self.bus.publish(event, db.session)
+
+            db.session.commit()
+
+            if event is not None:
+                self.bus.invalidate_locally(event)
+
+                if not self.bus.transport.transactional:
+                    self.bus.publish(event, None)
+
+            return entries[-1].seq
+
+        except:
+            db.session.rollback()
+            raise
+
+    def watermark(self):
+        """
+        Returns the highest sequence number which has been compacted away, or 0 if the log has never been compacted.
+        """
+        watermark = ChangeLogWatermark.query.get(1)
+
+        return watermark.seq if watermark is not None else 0
+
+    def latest_seq(self):
+        """
+        Returns the sequence number of the latest change, including changes which have been compacted away.
+        """
+        return max(db.session.query(func.max(QuestionChange.seq)).scalar() or 0, self.watermark())
+
+    def changes_since(self, since, limit):
+        """
+        Returns the changes with a sequence number greater than 'since', oldest first.
+
+        Args:
+            since: The sequence number of the last change the client has seen.
+            limit: The maximum number of changes to return.
+
+        Returns:
+            A list of objects which are instances of the 'QuestionChange' class/data model.
+
+        Raises:
+            LookupError: If changes after 'since' have been compacted away and the client has to resync.
+        """
+        if since < self.watermark():
+            raise LookupError(
+                f"Changes after {since} have been compacted away.")
+
+        return QuestionChange.query.filter(QuestionChange.seq > since).order_by(
+            QuestionChange.seq).limit(limit).all()
+
+    def compact(self):
+        """
+        Compacts the changes which are older than the retention window.
+
+        Returns:
+            The number of changes removed.
+        """
+        cutoff = time.time() - self.retention
+
+        with self.app.app_context():
+            try:
+                newer_change = aliased(QuestionChange)
+                is_superseded = exists().where(and_(
+                    newer_change.question_id == QuestionChange.question_id,
+                    newer_change.seq > QuestionChange.seq))
+
+                removed = QuestionChange.query.filter(
+                    QuestionChange.changed_at < cutoff, is_superseded).delete(synchronize_session=False)
+
+                old_tombstones = QuestionChange.query.filter(
+                    QuestionChange.changed_at < cutoff, QuestionChange.operation == 'delete')
+                highest_tombstone = old_tombstones.with_entities(
+                    func.max(QuestionChange.seq)).scalar()
+
+                if highest_tombstone is not None:
+                    removed += old_tombstones.delete(synchronize_session=False)
+
+                    watermark = ChangeLogWatermark.query.with_for_update().get(1)
+
+                    if watermark is None:
+                        db.session.add(ChangeLogWatermark(
+                            seq=highest_tombstone))
+                    else:
+                        watermark.seq = max(watermark.seq, highest_tombstone)
+
+                db.session.commit()
+
+                return removed
+
+            except:
+                db.session.rollback()
+                raise
@@ -0,0 +1,342 @@
+import sys
+import random
+import threading
+
+from models import Question
+
+from .leaderboard import ALL_CATEGORIES
+
+# The number of random picks from a pool before falling back to a scan for a question which has not been asked yet.
+MAX_REJECTIONS = 16
+
+
+class AliasTable:
+    """
+    Walker's alias method: after an O(n) setup, draws one of n outcomes with the given weights in constant time, using one random index and one biased coin flip.
+    """
+
+    def __init__(self, weights):
+        """
+        Args:
+            weights: A dictionary mapping each outcome to a positive weight.
+        """
+        self.outcomes = list(weights)
+
+        number_of_outcomes = len(self.outcomes)
+        total_weight = sum(weights.values())
+
+        scaled = [weights[outcome] * number_of_outcomes /
+                  total_weight for outcome in self.outcomes]
+        self.probabilities = [1.0] * number_of_outcomes
+        self.aliases = list(range(number_of_outcomes))
+
+        small = [index for index, weight in enumerate(scaled) if weight < 1]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1]
+
+        while small and large:
+            less, more = small.pop(), large.pop()
+
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def draw(self, rng=random):
+        index = rng.randrange(len(self.outcomes))
+
+        if rng.random() < self.probabilities[index]:
+            return self.outcomes[index]
+
+        return self.outcomes[self.aliases[index]]
+
+
+class IdPool:
+    """
+    An unordered array of question ids with O(1) insertion, removal (by swapping with the last id) and uniform sampling.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, question_id):
+        if question_id not in self.positions:
+            self.positions[question_id] = len(self.ids)
+            self.ids.append(question_id)
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+
+        if position is None:
+            return
+
+        last_id = self.ids.pop()
+
+        if last_id != question_id:
+            self.ids[position] = last_id
+            self.positions[last_id] = position
+
+    def sample(self, excluded_ids, rng=random):
+        """
+        Returns a random id which is not in excluded_ids, or None if every id is excluded.
+
+        A quiz only excludes the handful of questions asked so far, so a random pick almost always succeeds. Only when MAX_REJECTIONS picks in a row are excluded is the pool scanned.
+        """
+        if len(self.ids) == 0:
+            return None
+
+        for attempt in range(MAX_REJECTIONS):
+            question_id = self.ids[rng.randrange(len(self.ids))]
+
+            if question_id not in excluded_ids:
+                return question_id
+
+        remaining_ids = [
+            question_id for question_id in self.ids if question_id not in excluded_ids]
+
+        return rng.choice(remaining_ids) if remaining_ids else None
+
+
+class DifficultySampler:
+    """
+    Draws quiz questions of a target difficulty, or following a distribution over difficulties, in constant time.
+
+    The ids of the questions are kept in one pool per (category, difficulty) pair, plus one per difficulty for quizzes across all categories. A target difficulty draws from its pool, moving to the nearest difficulties once its questions have all been asked. A distribution picks a difficulty from an alias table over the non-empty pools, and then an id from that pool. There are only a few difficulties, so building the alias table per request is constant time as well.
+
+    The pools are loaded from the shards once and then kept up to date from the change feed: writes in this process are applied immediately, and writes in other processes by a background thread every 'sync_interval' seconds. If the feed has been compacted past the last synced change the pools are reloaded.
+    """
+
+    def __init__(self, app, shards, change_feed, sync_interval=1.0):
+        self.app = app
+        self.shards = shards
+        self.change_feed = change_feed
+        self.sync_interval = sync_interval
+
+        self.pools = {}
+        self.locations = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.loaded = False
+        self.draws = 0
+        self.syncs = 0
+
+    def start(self):
+        """
+        Loads the pools, unless they were loaded before (e.g. by a warm-up before forking), and starts the background sync thread. Calling this more than once has no effect.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        if not self.loaded:
+            self.refresh()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run, name='difficulty-sampler-sync', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.sync_interval):
+            try:
+                self.sync()
+            except:
+                print(sys.exc_info())
+
+    def _add(self, question_id, category_id, difficulty):
+        try:
+            # Like the snapshot, a question without a difficulty counts as difficulty 0.
+            location = (int(category_id), int(difficulty or 0))
+        except (TypeError, ValueError):
+            # A question without a (numeric) category cannot be drawn by any quiz.
+            self._remove(question_id)
+            return
+
+        if self.locations.get(question_id) == location:
+            return
+
+        self._remove(question_id)
+        self.locations[question_id] = location
+
+        for category in (location[0], ALL_CATEGORIES):
+            self.pools.setdefault(category, {}).setdefault(
+                location[1], IdPool()).add(question_id)
+
+    def _remove(self, question_id):
+        location = self.locations.pop(question_id, None)
+
+        if location is None:
+            return
+
+        for category in (location[0], ALL_CATEGORIES):
+            self.pools[category][location[1]].remove(question_id)
+
+    def add(self, question):
+        """
+        Adds a question, or moves it to the pool of its new category and difficulty.
+        """
+        with self.lock:
+            self._add(question.id, question.category, question.difficulty)
+
+    def discard(self, question_id):
+        """
+        Removes a question from its pools, e.g. after it has been deleted.
+        """
+        with self.lock:
+            self._remove(question_id)
+
+    def category_of(self, question_id):
+        """
+        Returns the category of a question in the pools, or None if it is not in any pool.
+        """
+        with self.lock:
+            location = self.locations.get(question_id)
+
+        return location[0] if location is not None else None
+
+    def refresh(self):
+        """
+        Reloads the pools from the id, category and difficulty columns of every shard.
+        """
+        with self.sync_lock, self.app.app_context():
+            # Read first, so that changes made during the load are replayed by the next sync.
+            version = self.change_feed.latest_seq()
+
+            rows = []
+
+            for session in self.shards.all_sessions():
+                rows.extend(session.query(
+                    Question.id, Question.category, Question.difficulty).all())
+
+        with self.lock:
+            self.pools = {}
+            self.locations = {}
+
+            for question_id, category_id, difficulty in rows:
+                self._add(question_id, category_id, difficulty)
+
+            self.version = version
+            self.loaded = True
+
+    def sync(self, batch_size=1000):
+        """
+        Applies the changes recorded since the last sync.
+
+        Returns:
+            The number of changes applied.
+        """
+        applied = 0
+
+        with self.sync_lock, self.app.app_context():
+            try:
+                while True:
+                    changes = self.change_feed.changes_since(
+                        self.version, batch_size)
+
+                    with self.lock:
+                        for change in changes:
+                            if change.operation == 'delete':
+                                self._remove(change.question_id)
+                            else:
+                                question = change.format()['question']
+                                self._add(
+                                    question['id'], question['category'], question['difficulty'])
+
+                            self.version = change.seq
+
+                    applied += len(changes)
+
+                    if len(changes) < batch_size:
+                        break
+
+            except LookupError:
+                # Deletes we have not seen were compacted away, so start over from the shards.
+                needs_refresh = True
+            else:
+                needs_refresh = False
+
+        if needs_refresh:
+            self.refresh()
+
+        self.syncs += 1
+
+        return applied
+
+    def draw(self, category_id, previous_questions, difficulty=None, distribution=None):
+        """
+        Returns the id of a random question which is not in the list of previous questions.
+
+        Args:
+            category_id: The id of the quiz category, or 0 for quizzes across all categories.
+            previous_questions: A list of the ids of the questions which have already been asked.
+            difficulty: (Optional) The target difficulty. The nearest difficulty with questions left is used when none of this difficulty are left.
+            distribution: (Optional) A dictionary mapping difficulties to relative weights, used when no target difficulty is given. Once the weighted difficulties run out, any remaining question is drawn.
+
+        Returns:
+            The id of the question, or None if every question of the category has been asked.
+        """
+        excluded_ids = set(previous_questions)
+        category_id = int(category_id)
+
+        with self.lock:
+            self.draws += 1
+
+            pools = {level: pool for level, pool in self.pools.get(category_id, {}).items()
+                     if len(pool) > 0}
+
+            if difficulty is not None:
+                for level in sorted(pools, key=lambda level: (abs(level - difficulty), level)):
+                    question_id = pools[level].sample(excluded_ids)
+
+                    if question_id is not None:
+                        return question_id
+
+                return None
+
+            weights = {level: weight for level, weight in (distribution or {}).items()
+                       if weight > 0 and level in pools}
+
+            # Weighting every difficulty by its number of questions draws uniformly from what is left.
+            for weights in (weights, {level: len(pool) for level, pool in pools.items()}):
+                while weights:
+                    level = AliasTable(weights).draw()
+                    question_id = pools[level].sample(excluded_ids)
+
+                    if question_id is not None:
+                        return question_id
+
+                    # Every question of this difficulty has been asked.
+                    del weights[level]
+
+            return None
+
+    def metrics(self):
+        with self.lock:
+            pool_sizes = {}
+
+            for category_id, category_pools in self.pools.items():
+                if category_id != ALL_CATEGORIES:
+                    pool_sizes[category_id] = {difficulty: len(pool)
+                                               for difficulty, pool in category_pools.items() if len(pool) > 0}
+
+            return {
+                "sync_interval": self.sync_interval,
+                "version": self.version,
+                "pools": pool_sizes,
+                "draws": self.draws,
+                "syncs": self.syncs
+            }
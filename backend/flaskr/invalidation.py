@@ -0,0 +1,417 @@
+import os
+import sys
+import json
+import uuid
+import select
+import socket
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from models import db
+
+INVALIDATION_BACKENDS = ('auto', 'postgres', 'unix')
+
+
+class QueryCache:
+    """
+    An in-process cache of query results, grouped into scopes of (table, category) pairs. A category of None holds the results which span every category of the table, e.g. a page of questions.
+
+    Every scope has a generation which is bumped whenever it is invalidated. A result is only stored if the generation it was loaded under is still current, so a query which races an invalidation can never put a stale result back into the cache.
+
+    At most 'max_entries' results are kept. Once the cache is full, the least recently used result is evicted.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.entries = {}
+        # Every cached (scope, key) pair, least recently used first.
+        self.recently_used = OrderedDict()
+        self.epoch = 0
+        self.table_generations = {}
+        self.scope_generations = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.resets = 0
+        self.evictions = 0
+
+    def _generation(self, scope):
+        return (self.epoch, self.table_generations.get(scope[0], 0), self.scope_generations.get(scope, 0))
+
+    def _drop(self, scope):
+        for key in self.entries.pop(scope, {}):
+            del self.recently_used[(scope, key)]
+
+    def get(self, scope, key, load, cache_empty=True):
+        """
+        Returns the cached result for the given key, or calls load() and caches its result.
+
+        Args:
+            scope: A (table, category) tuple which decides which events invalidate the result.
+            key: A hashable key identifying the result within its scope.
+            load: A function which queries the result.
+            cache_empty: (Optional) Whether an empty result is cached. Pass False when the key comes from the client, e.g. a page number, so that requests for results which do not exist cannot fill the cache.
+        """
+        with self.lock:
+            scope_entries = self.entries.get(scope)
+
+            if scope_entries is not None and key in scope_entries:
+                self.hits += 1
+                self.recently_used.move_to_end((scope, key))
+                return scope_entries[key]
+
+            self.misses += 1
+            generation = self._generation(scope)
+
+        value = load()
+
+        if not cache_empty and len(value) == 0:
+            return value
+
+        with self.lock:
+            if self._generation(scope) == generation:
+                self.entries.setdefault(scope, {})[key] = value
+                self.recently_used[(scope, key)] = None
+                self.recently_used.move_to_end((scope, key))
+
+                while len(self.recently_used) > self.max_entries:
+                    (evicted_scope, evicted_key), _ = self.recently_used.popitem(last=False)
+                    scope_entries = self.entries[evicted_scope]
+                    del scope_entries[evicted_key]
+
+                    if len(scope_entries) == 0:
+                        del self.entries[evicted_scope]
+
+                    self.evictions += 1
+
+        return value
+
+    def invalidate(self, table, category=None):
+        """
+        Drops the cached results of a category, together with the results which span every category of its table. Without a category every result of the table is dropped.
+        """
+        with self.lock:
+            if category is None:
+                self.table_generations[table] = self.table_generations.get(
+                    table, 0) + 1
+
+                for scope in [scope for scope in self.entries if scope[0] == table]:
+                    self._drop(scope)
+            else:
+                for scope in ((table, category), (table, None)):
+                    self.scope_generations[scope] = self.scope_generations.get(
+                        scope, 0) + 1
+                    self._drop(scope)
+
+            self.invalidations += 1
+
+    def clear(self):
+        """
+        Drops every cached result.
+        """
+        with self.lock:
+            self.epoch += 1
+            self.entries = {}
+            self.recently_used = OrderedDict()
+            self.resets += 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "cached_results": len(self.recently_used),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "resets": self.resets
+            }
+
+
+class PostgresNotifyTransport:
+    """
+    Delivers invalidation events with Postgres LISTEN/NOTIFY.
+
+    Events are sent with pg_notify() inside the transaction which records the change, so Postgres delivers them only if the change commits, and in commit order.
+    """
+
+    transactional = True
+
+    def __init__(self, engine, channel):
+        self.engine = engine
+        self.channel = channel
+        self.connection = None
+
+    def open(self):
+        connection = self.engine.raw_connection()
+        # The listening connection must not go back to the pool, where it would keep receiving notifications.
+        connection.detach()
+
+        self.connection = connection.connection
+        self.connection.autocommit = True
+
+        cursor = self.connection.cursor()
+        cursor.execute(f'LISTEN "{self.channel}"')
+        cursor.close()
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            finally:
+                self.connection = None
+
+    def send(self, payload, session):
+        session.execute(text('SELECT pg_notify(:channel, :payload)'), {
+            "channel": self.channel, "payload": payload})
+
+    def receive(self, timeout):
+        if select.select([self.connection], [], [], timeout) == ([], [], []):
+            return []
+
+        self.connection.poll()
+
+        payloads = [notify.payload for notify in self.connection.notifies]
+        del self.connection.notifies[:]
+
+        return payloads
+
+
+class UnixSocketTransport:
+    """
+    Delivers invalidation events between the processes of one host over Unix datagram sockets, for databases without LISTEN/NOTIFY.
+
+    Every process binds a socket in a shared directory and sends each event to every socket there, including its own. Datagrams from one sender arrive in order. A socket whose process has gone away is removed by the next sender.
+    """
+
+    transactional = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.receiver = None
+        self.sender = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.path = os.path.join(
+            self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+
+        self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.receiver.bind(self.path)
+
+        # A request must never block on a slow receiver. An event it misses is detected by the version check.
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+
+    def close(self):
+        for sock in (self.receiver, self.sender):
+            if sock is not None:
+                sock.close()
+
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+        self.receiver = self.sender = self.path = None
+
+    def send(self, payload, session=None):
+        if self.sender is None:
+            return
+
+        data = payload.encode()
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.sock'):
+                continue
+
+            path = os.path.join(self.directory, name)
+
+            try:
+                self.sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError:
+                print(sys.exc_info())
+
+    def receive(self, timeout):
+        if select.select([self.receiver], [], [], timeout) == ([], [], []):
+            return []
+
+        payloads = []
+
+        while True:
+            try:
+                payloads.append(self.receiver.recv(65536, socket.MSG_DONTWAIT).decode())
+            except BlockingIOError:
+                return payloads
+
+
+class InvalidationBus:
+    """
+    Broadcasts invalidation events for the question bank to every server process, so that each can cache query results until they actually change.
+
+    Every event carries the range of change feed sequence numbers it covers. A process applies events in version order: an event it has already seen is ignored, and an event which skips a version means that an event was missed (or arrived out of order), so the whole cache is dropped. A lost event is only noticed this way once a later one arrives, so whenever no event arrives within 'poll_interval' seconds, the version is also compared with the latest change in the change feed. The writing process invalidates its own cache as soon as the change commits.
+
+    A background thread receives the events. Transports hold sockets and connections, so a preloading server has to start the bus in every worker process.
+    """
+
+    def __init__(self, app, change_feed, transport, cache, poll_interval=0.5):
+        self.app = app
+        self.change_feed = change_feed
+        self.transport = transport
+        self.cache = cache
+        self.poll_interval = poll_interval
+
+        self.lock = threading.Lock()
+        self.version = 0
+        self.events_applied = 0
+        self.events_skipped = 0
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.connect()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run, name='invalidation-bus', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        self.transport.close()
+
+    def connect(self):
+        """
+        Opens the transport and starts again from the latest version with an empty cache, since events sent while the transport was closed are lost.
+        """
+        self.transport.open()
+
+        with self.app.app_context():
+            version = self.change_feed.latest_seq()
+
+        with self.lock:
+            self.version = version
+            self.cache.clear()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                payloads = self.transport.receive(self.poll_interval)
+
+                for payload in payloads:
+                    self.apply(json.loads(payload))
+
+                if len(payloads) == 0:
+                    self.catch_up()
+            except:
+                print(sys.exc_info())
+
+                self.transport.close()
+                self.stopped.wait(self.poll_interval)
+
+                if not self.stopped.is_set():
+                    try:
+                        self.connect()
+                    except:
+                        print(sys.exc_info())
+
+    @staticmethod
+    def event_for(changes):
+        """
+        Returns the invalidation event for a batch of changes: a category-level event when they all belong to one category, or else a table-level event.
+
+        Args:
+            changes: A list of objects which are instances of the 'QuestionChange' class/data model, in sequence order.
+        """
+        categories = {int(change.category) for change in changes}
+
+        return {
+            "table": "questions",
+            "category": categories.pop() if len(categories) == 1 else None,
+            "first_version": changes[0].seq,
+            "version": changes[-1].seq
+        }
+
+    def publish(self, event, session):
+        """
+        Sends an event to every process. With a transactional transport this has to be called before the change is committed, and otherwise after.
+        """
+        self.transport.send(json.dumps(event), session)
+
+    def invalidate_locally(self, event):
+        self.cache.invalidate(event['table'], event['category'])
+
+    def apply(self, event):
+        """
+        Applies an event received from the transport.
+        """
+        with self.lock:
+            if event['version'] <= self.version:
+                self.events_skipped += 1
+                return
+
+            if event['first_version'] > self.version + 1:
+                self.cache.clear()
+            else:
+                self.cache.invalidate(event['table'], event['category'])
+
+            self.version = event['version']
+            self.events_applied += 1
+
+    def catch_up(self):
+        """
+        Drops the whole cache if the change feed has moved on from the version of the last applied event, e.g. because the last event of a burst was lost.
+        """
+        with self.app.app_context():
+            version = self.change_feed.latest_seq()
+
+        with self.lock:
+            if version != self.version:
+                self.cache.clear()
+                self.version = version
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.cache.metrics(), **{
+                "transport": type(self.transport).__name__,
+                "version": self.version,
+                "events_applied": self.events_applied,
+                "events_skipped": self.events_skipped
+            })
+
+
+def create_transport(app, backend, channel, socket_directory):
+    """
+    A helper function which returns the transport for the INVALIDATION_BUS_BACKEND setting. 'auto' uses LISTEN/NOTIFY on Postgres and Unix sockets on any other database.
+    """
+    if backend not in INVALIDATION_BACKENDS:
+        raise ValueError(
+            f"Unknown invalidation bus backend '{backend}'. Use one of {INVALIDATION_BACKENDS}.")
+
+    engine = db.get_engine(app)
+
+    if backend == 'postgres' or (backend == 'auto' and engine.dialect.name == 'postgresql'):
+        return PostgresNotifyTransport(engine, channel)
+
+    return UnixSocketTransport(socket_directory)
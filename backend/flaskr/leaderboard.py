@@ -0,0 +1,204 @@
+import sys
+import time
+import heapq
+import threading
+
+from models import db, QuizResult, Category
+
+# The category id the frontend sends for quizzes which draw from every category.
+ALL_CATEGORIES = 0
+
+
+class Leaderboard:
+    """
+    Accepts quiz results in memory, writes them to the 'quiz_results' table in periodic batches, and serves the top K results of every category from in-memory heaps.
+
+    Every category has a min-heap of at most K results, so a submission costs O(log K) and a leaderboard read O(K log K), however many results are stored. Ties are broken in favour of the earlier submission.
+
+    A background thread flushes the pending results every 'flush_interval' seconds, or as soon as 'max_pending' results are waiting. The heaps are refreshed from the top K rows of each category, using the (category, score) index, right after a flush which wrote results and otherwise every 'refresh_interval' seconds, so the heaps of all the worker processes converge on the results submitted to any of them without every idle worker querying each category once a second.
+    """
+
+    def __init__(self, app, top_k=10, flush_interval=1.0, max_pending=1000, refresh_interval=10.0):
+        self.app = app
+        self.top_k = top_k
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.refresh_interval = refresh_interval
+
+        self.pending = []
+        self.heaps = {}
+        self.lock = threading.Lock()
+        self.flush_needed = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.loaded = False
+        self.results_flushed = 0
+        self.flushes = 0
+        self.refreshes = 0
+
+    def start(self):
+        """
+        Loads the heaps from the database, unless they were loaded before (e.g. by a warm-up before forking), and starts the background flush thread. Calling this more than once has no effect.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        if not self.loaded:
+            self.refresh()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run, name='leaderboard-flush', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread after flushing any pending results.
+        """
+        self.stopped.set()
+        self.flush_needed.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        last_refresh = time.monotonic()
+
+        while True:
+            self.flush_needed.wait(self.flush_interval)
+            self.flush_needed.clear()
+
+            try:
+                if self.flush() > 0 or time.monotonic() - last_refresh >= self.refresh_interval:
+                    self.refresh()
+                    last_refresh = time.monotonic()
+            except:
+                print(sys.exc_info())
+
+            if self.stopped.is_set():
+                break
+
+    @staticmethod
+    def _heap_entry(result):
+        return (result['score'], -result['submitted_at'], result['player'], result['total_questions'])
+
+    def _push(self, category_id, entry):
+        heap = self.heaps.setdefault(category_id, [])
+
+        if len(heap) < self.top_k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def submit(self, player, category_id, score, total_questions):
+        """
+        Queues a quiz result for the next batch and adds it to the leaderboard of its category.
+
+        Returns:
+            A dictionary representing the result.
+        """
+        result = {
+            "player": player,
+            "category": category_id,
+            "score": score,
+            "total_questions": total_questions,
+            "submitted_at": time.time()
+        }
+
+        with self.lock:
+            self.pending.append(result)
+            self._push(category_id, self._heap_entry(result))
+
+            if len(self.pending) >= self.max_pending:
+                self.flush_needed.set()
+
+        return result
+
+    def flush(self):
+        """
+        Writes the pending results to the database in a single batch.
+
+        Returns:
+            The number of results written.
+        """
+        with self.lock:
+            batch, self.pending = self.pending, []
+
+        if len(batch) == 0:
+            return 0
+
+        with self.app.app_context():
+            try:
+                db.session.bulk_insert_mappings(QuizResult, batch)
+                db.session.commit()
+            except:
+                db.session.rollback()
+
+                # Put the batch back so that it is retried by the next flush.
+                with self.lock:
+                    self.pending = batch + self.pending
+                raise
+
+        self.results_flushed += len(batch)
+        self.flushes += 1
+
+        return len(batch)
+
+    def refresh(self):
+        """
+        Rebuilds the heaps from the top K stored results of every category, plus the results which have not been flushed yet.
+        """
+        with self.app.app_context():
+            category_ids = [ALL_CATEGORIES] + \
+                [category.id for category in Category.query.all()]
+
+            stored_results = {}
+
+            for category_id in category_ids:
+                stored_results[category_id] = [result.format() for result in QuizResult.query.filter(
+                    QuizResult.category == category_id).order_by(
+                    QuizResult.score.desc(), QuizResult.submitted_at).limit(self.top_k).all()]
+
+        with self.lock:
+            self.heaps = {}
+
+            for category_id, results in stored_results.items():
+                for result in results:
+                    self._push(category_id, self._heap_entry(result))
+
+            for result in self.pending:
+                self._push(result['category'], self._heap_entry(result))
+
+            self.loaded = True
+            self.refreshes += 1
+
+    def top(self, category_id):
+        """
+        Returns the best results of the given category, best first.
+        """
+        with self.lock:
+            entries = sorted(self.heaps.get(category_id, []), reverse=True)
+
+        return [{
+            "rank": rank,
+            "player": player,
+            "score": score,
+            "total_questions": total_questions,
+            "submitted_at": -negative_submitted_at
+        } for rank, (score, negative_submitted_at, player, total_questions) in enumerate(entries, start=1)]
+
+    def metrics(self):
+        with self.lock:
+            pending_results = len(self.pending)
+
+        return {
+            "top_k": self.top_k,
+            "flush_interval": self.flush_interval,
+            "refresh_interval": self.refresh_interval,
+            "pending_results": pending_results,
+            "results_flushed": self.results_flushed,
+            "flushes": self.flushes,
+            "refreshes": self.refreshes
+        }
@@ -0,0 +1,76 @@
+from models import db
+
+
+def background_workers(app):
+    """
+    Returns the components of the app which run a background thread, in the order in which they are started.
+    """
+    return app.extensions.get('trivia_background_workers', [])
+
+
+def start_background_workers(app):
+    """
+    Starts the background threads of the app. Threads do not survive a fork, so a preloading server has to call this in every worker process.
+    """
+    for worker in background_workers(app):
+        worker.start()
+
+
+def stop_background_workers(app):
+    """
+    Stops the background threads of the app, giving them the chance to write out buffered state (e.g. pending quiz results).
+    """
+    for worker in reversed(background_workers(app)):
+        worker.stop()
+
+
+def dispose_connections(app):
+    """
+    Closes every pooled database connection of the app, so that forked worker processes open their own connections instead of sharing the sockets of the parent.
+    """
+    shards = app.extensions['trivia_shards']
+    shards.remove()
+
+    db.get_engine(app).dispose()
+
+    for engine in shards.engines.values():
+        engine.dispose()
+
+
+def warm_up(app):
+    """
+    Primes the category and question data of the app and marks it as ready to serve traffic.
+
+    Every category's questions are read once from their shard, which warms the database buffer cache and the SQLAlchemy statement caches. The quiz buffers, the difficulty pools, the snapshot mapping and the leaderboards are filled, so that when this runs before forking the worker processes share them copy-on-write.
+
+    Args:
+        app: The flask application.
+    """
+    # Imported here since flaskr imports this module.
+    from . import get_categories
+
+    shards = app.extensions['trivia_shards']
+
+    with app.app_context():
+        try:
+            category_ids = list(get_categories())
+
+            for category_id in category_ids:
+                shards.query_for_category(category_id).all()
+
+            shards.paginate(1, 10)
+        finally:
+            shards.remove()
+
+    if app.extensions['trivia_quiz_buffer'] is not None:
+        app.extensions['trivia_quiz_buffer'].refill()
+
+    if app.extensions['trivia_snapshots'] is not None:
+        app.extensions['trivia_snapshots'].current()
+
+    if app.extensions['trivia_difficulty_sampler'] is not None:
+        app.extensions['trivia_difficulty_sampler'].refresh()
+
+    app.extensions['trivia_leaderboard'].refresh()
+
+    app.extensions['trivia_ready'] = True
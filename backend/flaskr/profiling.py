@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import uuid
+import cProfile
+import threading
+from functools import wraps
+from itertools import count
+
+from flask import request, g, has_request_context
+from sqlalchemy import event
+
+PROFILE_FORMATS = ('pstats', 'speedscope')
+
+
+def parse_sample_routes(value):
+    """
+    A helper function which parses the PROFILE_SAMPLE_ROUTES setting.
+
+    Args:
+        value: Either a dictionary of endpoint: N pairs, or a string of comma separated endpoint:N pairs, e.g. 'get_questions_for_quiz:100,search_questions:10'.
+
+    Returns:
+        A dictionary mapping endpoint names to N, meaning that 1 in N requests to the endpoint is profiled.
+
+    Raises:
+        ValueError: If an N is not a positive integer, so that a typo fails at startup rather than on every request to the route.
+    """
+    if isinstance(value, dict):
+        items = value.items()
+    else:
+        items = [item.rsplit(':', 1)
+                 for item in (value or '').split(',') if item.strip()]
+
+    sample_routes = {}
+
+    for endpoint, rate in items:
+        rate = int(rate)
+
+        if rate < 1:
+            raise ValueError(
+                f"The sampling rate of '{endpoint}' must be at least 1, got {rate}.")
+
+        sample_routes[str(endpoint).strip()] = rate
+
+    return sample_routes
+
+
+class StackSampler:
+    """
+    A sampling profiler which records the call stack of one thread at a fixed interval from a background thread.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+
+        self.frames = []
+        self.frame_indexes = {}
+        self.samples = []
+        self.weights = []
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.end_time = time.perf_counter()
+
+    def frame_index(self, code):
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+
+        if key not in self.frame_indexes:
+            self.frame_indexes[key] = len(self.frames)
+            self.frames.append(
+                {"name": key[0], "file": key[1], "line": key[2]})
+
+        return self.frame_indexes[key]
+
+    def run(self):
+        last_sample_time = time.perf_counter()
+
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_index(frame.f_code))
+                frame = frame.f_back
+
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append(now - last_sample_time)
+            last_sample_time = now
+
+
+class RequestProfiler:
+    """
+    Profiles single requests on demand, and 1 in N requests to selected routes.
+
+    A request is profiled when it carries an authorized 'X-Profile' header or 'profile' query parameter, whose value selects the output format, or when it is picked by the sampling rate of its route. The view function is then run under cProfile ('pstats') or a stack sampler ('speedscope'), and the time spent in SQL statements is recorded alongside the profile.
+
+    When a request is not profiled the only overhead is a header lookup, a counter increment on sampled routes, and an attribute check in the SQL hooks.
+    """
+
+    def __init__(self, directory='profiles', default_format='pstats', sample_routes=None, sampling_interval_ms=1.0, is_authorized=None):
+        if default_format not in PROFILE_FORMATS:
+            raise ValueError(
+                f"Unknown profile format '{default_format}'. Use one of {PROFILE_FORMATS}.")
+
+        self.directory = directory
+        self.default_format = default_format
+        self.sample_routes = sample_routes or {}
+        self.sampling_interval = sampling_interval_ms / 1000
+        self.is_authorized = is_authorized or (lambda: False)
+
+        self.counters = {endpoint: count()
+                         for endpoint in self.sample_routes}
+
+    def attach(self, engine):
+        """
+        Registers the SQL timing hooks on a SQLAlchemy engine.
+        """
+        event.listen(engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Like the slow-query log, the start time is kept on the execution context, since after_cursor_execute is not called for a statement which fails.
+        if context is not None and has_request_context() and g.get('profile_sql_timings') is not None:
+            context.profile_start_time = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_time = getattr(context, 'profile_start_time', None)
+
+        if start_time is not None and has_request_context() and g.get('profile_sql_timings') is not None:
+            g.profile_sql_timings.append(
+                (statement, start_time, time.perf_counter()))
+
+    def requested_format(self, endpoint):
+        """
+        Returns the format in which the current request should be profiled, or None if it should not be profiled.
+        """
+        requested = request.headers.get(
+            'X-Profile') or request.args.get('profile')
+
+        if requested:
+            if not self.is_authorized():
+                return None
+            return requested if requested in PROFILE_FORMATS else self.default_format
+
+        counter = self.counters.get(endpoint)
+
+        if counter is not None and next(counter) % self.sample_routes[endpoint] == 0:
+            return self.default_format
+
+        return None
+
+    def wrap(self, endpoint, view):
+        """
+        Returns the view function wrapped so that it is profiled when the current request asks for it.
+        """
+        @wraps(view)
+        def profiled_view(*args, **kwargs):
+            profile_format = self.requested_format(endpoint)
+
+            if profile_format is None:
+                return view(*args, **kwargs)
+
+            return self.profile(endpoint, profile_format, view, *args, **kwargs)
+
+        return profiled_view
+
+    def wrap_views(self, app):
+        for endpoint, view in list(app.view_functions.items()):
+            if endpoint != 'static':
+                app.view_functions[endpoint] = self.wrap(endpoint, view)
+
+    def profile(self, endpoint, profile_format, view, *args, **kwargs):
+        g.profile_sql_timings = []
+        start_time = time.perf_counter()
+
+        if profile_format == 'pstats':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                profiler.disable()
+        else:
+            profiler = StackSampler(
+                threading.get_ident(), self.sampling_interval)
+            profiler.start()
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                profiler.stop()
+
+        sql_timings = g.pop('profile_sql_timings')
+
+        try:
+            self.write(endpoint, profile_format, profiler,
+                       start_time, sql_timings)
+        except:
+            print(sys.exc_info())
+
+        return response
+
+    def write(self, endpoint, profile_format, profiler, start_time, sql_timings):
+        """
+        Writes a profile, and a summary of the SQL statements issued while it was recorded, to the profile directory.
+
+        Returns:
+            The path of the profile.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(self.directory, name)
+
+        sql_summary = {
+            "endpoint": endpoint,
+            "path": request.full_path,
+            "sql_time": sum(end - start for statement, start, end in sql_timings),
+            "statements": [{"statement": statement, "start": start - start_time, "duration": end - start}
+                           for statement, start, end in sql_timings]
+        }
+
+        if profile_format == 'pstats':
+            profiler.dump_stats(path + '.prof')
+
+            with open(path + '.sql.json', 'w') as sql_file:
+                json.dump(sql_summary, sql_file, indent=2)
+
+            return path + '.prof'
+
+        frames = list(profiler.frames)
+        sql_events = []
+
+        for statement in sql_summary['statements']:
+            frames.append({"name": statement['statement']})
+            sql_events.append(
+                {"type": "O", "frame": len(frames) - 1, "at": statement['start']})
+            sql_events.append({"type": "C", "frame": len(frames) - 1,
+                               "at": statement['start'] + statement['duration']})
+
+        end_value = profiler.end_time - start_time
+
+        speedscope_profile = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"{endpoint} {request.full_path}",
+            "exporter": "trivia-api",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": f"{endpoint} (SQL time: {sql_summary['sql_time'] * 1000:.1f} ms)",
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": end_value,
+                    "samples": profiler.samples,
+                    "weights": profiler.weights
+                },
+                {
+                    "type": "evented",
+                    "name": "SQL statements",
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": end_value,
+                    "events": sql_events
+                }
+            ]
+        }
+
+        with open(path + '.speedscope.json', 'w') as speedscope_file:
+            json.dump(speedscope_profile, speedscope_file)
+
+        return path + '.speedscope.json'
@@ -0,0 +1,247 @@
+import sys
+import random
+import threading
+from collections import deque
+
+from sqlalchemy import func
+
+from models import Question, Category
+
+
+class QuizQuestionBuffer:
+    """
+    Keeps a ring buffer of randomly sampled, pre-serialized questions for every category so that quiz requests do not have to query the database.
+
+    A background worker thread tops the buffers up every 'refill_interval' seconds. A pass starts sooner when a buffer drops below half of its depth or runs empty, unless the last pass found no more questions for the category, e.g. because it has fewer questions than half the depth. Each pass samples at most 'refill_batch' questions per category, which bounds the load the worker puts on the database.
+
+    Quiz requests take the first buffered question which is not in the list of previous questions. When no buffered question qualifies the caller falls back to the database.
+
+    A delete handled by this process drops the question straight away. Deletes handled by other processes are read from the change feed at the start of every refill pass.
+    """
+
+    def __init__(self, app, shards, change_feed, depth=50, refill_interval=1.0, refill_batch=25):
+        self.app = app
+        self.shards = shards
+        self.change_feed = change_feed
+        self.depth = depth
+        self.refill_interval = refill_interval
+        self.refill_batch = refill_batch
+
+        self.buffers = {}
+        # The categories for which the last pass sampled fewer questions than it asked for, so an early pass would not find more.
+        self.exhausted = set()
+        # The sequence number of the last change feed entry which has been applied to the buffers.
+        self.version = None
+        self.lock = threading.Lock()
+        self.refill_lock = threading.Lock()
+        self.refill_needed = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.questions_sampled = 0
+
+    def start(self):
+        """
+        Starts the background refill thread. Calling this more than once has no effect.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run, name='quiz-buffer-refill', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.refill_needed.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refill()
+            except:
+                print(sys.exc_info())
+
+            self.refill_needed.wait(self.refill_interval)
+            self.refill_needed.clear()
+
+    def refill(self):
+        """
+        Tops up the buffer of every category with questions sampled at random from the shard which owns the category.
+        """
+        with self.refill_lock, self.app.app_context():
+            self.drop_deleted()
+
+            category_ids = [category.id for category in Category.query.all()]
+
+            for category_id in category_ids:
+                with self.lock:
+                    buffer = self.buffers.setdefault(
+                        category_id, deque(maxlen=self.depth))
+                    buffered_ids = [question['id'] for question in buffer]
+
+                missing = min(self.depth - len(buffered_ids),
+                              self.refill_batch)
+
+                if missing <= 0:
+                    continue
+
+                sampled_questions = [question.format() for question in self.sample(
+                    category_id, buffered_ids, missing)]
+
+                with self.lock:
+                    buffer.extend(sampled_questions)
+                    self.questions_sampled += len(sampled_questions)
+
+                    if len(sampled_questions) < missing:
+                        self.exhausted.add(category_id)
+                    else:
+                        self.exhausted.discard(category_id)
+
+            self.refills += 1
+
+    def sample(self, category_id, excluded_ids, count):
+        """
+        Returns up to 'count' questions of a category, in random order, which are not in the list of excluded ids.
+
+        Instead of sorting the whole category with ORDER BY random(), the questions are read in id order through the primary key, starting from a random id and wrapping around to the lowest ids. A pass therefore reads about 'count' rows of the category, plus the rows of other categories stored between them, rather than all of them. Questions which follow a gap in the ids are picked a little more often, which is fine for keeping quizzes varied.
+        """
+        session = self.shards.session_for_category(category_id)
+        highest_id = session.query(func.max(Question.id)).scalar()
+
+        if highest_id is None:
+            return []
+
+        start_id = random.randint(1, highest_id)
+        question_query = self.shards.query_for_category(category_id)
+
+        if excluded_ids:
+            question_query = question_query.filter(
+                ~Question.id.in_(excluded_ids))
+
+        questions = question_query.filter(Question.id >= start_id).order_by(
+            Question.id).limit(count).all()
+
+        if len(questions) < count:
+            questions += question_query.filter(Question.id < start_id).order_by(
+                Question.id).limit(count - len(questions)).all()
+
+        random.shuffle(questions)
+
+        return questions
+
+    def drop_deleted(self, batch_size=1000):
+        """
+        Discards the questions which have been deleted since the last pass, by any server process. Has to be called within an app context.
+        """
+        if self.version is None:
+            # Nothing has been buffered yet, so only the deletes from now on matter.
+            self.version = self.change_feed.latest_seq()
+            return
+
+        try:
+            while True:
+                changes = self.change_feed.changes_since(
+                    self.version, batch_size)
+
+                for change in changes:
+                    if change.operation == 'delete':
+                        self.discard(change.question_id)
+
+                    self.version = change.seq
+
+                if len(changes) < batch_size:
+                    break
+
+        except LookupError:
+            # Deletes we have not seen were compacted away, so start over.
+            with self.lock:
+                self.buffers = {}
+
+            self.version = self.change_feed.latest_seq()
+
+    def draw(self, category_id, previous_questions):
+        """
+        Removes and returns a buffered question for the given category which is not in the list of previous questions.
+
+        Args:
+            category_id: The id of the quiz category.
+            previous_questions: A list of the ids of the questions which have already been asked.
+
+        Returns:
+            A dictionary representing the question, or None if the buffer cannot satisfy the request.
+        """
+        excluded_ids = set(previous_questions)
+
+        # The frontend sends the category id as a string since it reads it from the keys of the categories object.
+        try:
+            category_id = int(category_id)
+        except (TypeError, ValueError):
+            category_id = None
+
+        with self.lock:
+            buffer = self.buffers.get(category_id)
+            next_question = None
+
+            if buffer is not None:
+                for question in buffer:
+                    if question['id'] not in excluded_ids:
+                        next_question = question
+                        break
+
+            # Only a category which had more questions to offer in the last pass is refilled early. A category the refill thread has not seen yet waits for the next pass, so requests for unknown categories cannot trigger passes.
+            can_refill = buffer is not None and category_id not in self.exhausted
+
+            if next_question is None:
+                self.misses += 1
+
+                # An empty buffer sends every request for the category to the database, so refill it straight away.
+                if can_refill and len(buffer) == 0:
+                    self.refill_needed.set()
+
+                return None
+
+            buffer.remove(next_question)
+            self.hits += 1
+
+            if can_refill and len(buffer) < self.depth // 2:
+                self.refill_needed.set()
+
+            return next_question
+
+    def discard(self, question_id):
+        """
+        Removes a question from every buffer, e.g. after it has been deleted.
+        """
+        with self.lock:
+            for buffer in self.buffers.values():
+                for question in list(buffer):
+                    if question['id'] == question_id:
+                        buffer.remove(question)
+
+    def metrics(self):
+        """
+        Returns a dictionary describing the configuration and the state of the buffers.
+        """
+        with self.lock:
+            buffered_questions = {category_id: len(buffer)
+                                  for category_id, buffer in self.buffers.items()}
+
+        return {
+            "depth": self.depth,
+            "refill_interval": self.refill_interval,
+            "refill_batch": self.refill_batch,
+            "buffered_questions": buffered_questions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refills": self.refills,
+            "questions_sampled": self.questions_sampled
+        }
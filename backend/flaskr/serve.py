@@ -0,0 +1,116 @@
+"""
+The production entry point of the API.
+
+Runs the app under gunicorn with the app preloaded in the master process. The app is created and warmed up (categories, questions, quiz buffers, snapshot and leaderboards) before any worker is forked, so the workers share that memory copy-on-write and every worker is ready as soon as it starts.
+
+Usage, from within the backend directory:
+
+    python -m flaskr.serve
+
+Signals (sent to the master process):
+    HUP   gracefully replaces every worker with a fresh fork of the preloaded master.
+    USR2  starts a new master with the current code, for zero-downtime deploys. Send TERM to the old master once the new one is ready.
+    TERM  stops accepting connections and drains in-flight requests for up to SERVER_GRACEFUL_TIMEOUT seconds before exiting.
+"""
+import os
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+from . import create_app
+from .lifecycle import warm_up, dispose_connections, start_background_workers, stop_background_workers
+
+
+def available_cores():
+    """
+    Returns the number of CPU cores this process may run on, which respects container and taskset limits where the platform reports them.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def default_options():
+    """
+    Returns the gunicorn options, sized from the number of cores and overridable through environment variables.
+
+    The API spends most of its time waiting on the database, so every core gets one worker process with several threads. Workers are recycled after SERVER_MAX_REQUESTS requests (with jitter, so they do not all restart at once) to bound memory growth.
+    """
+    cores = available_cores()
+    threads = int(os.getenv('SERVER_THREADS', 4))
+
+    return {
+        'bind': os.getenv('SERVER_BIND', f"0.0.0.0:{os.getenv('PORT', 8000)}"),
+        'workers': int(os.getenv('SERVER_WORKERS', cores)),
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'preload_app': True,
+        'timeout': int(os.getenv('SERVER_TIMEOUT', 30)),
+        'graceful_timeout': int(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30)),
+        'keepalive': int(os.getenv('SERVER_KEEPALIVE', 5)),
+        'max_requests': int(os.getenv('SERVER_MAX_REQUESTS', 10000)),
+        'max_requests_jitter': int(os.getenv('SERVER_MAX_REQUESTS_JITTER', 1000)),
+        'accesslog': os.getenv('SERVER_ACCESS_LOG', '-'),
+    }
+
+
+class TriviaServer(BaseApplication):
+    """
+    A gunicorn application which preloads and warms up the trivia API before forking its workers.
+    """
+
+    def __init__(self, app_factory=None, options=None):
+        self.app_factory = app_factory or (
+            lambda: create_app({'DEFER_BACKGROUND_WORKERS': True}))
+        self.options = dict(default_options(), **(options or {}))
+        self.application = None
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+        self.cfg.set('post_fork', self.post_fork)
+        self.cfg.set('worker_int', self.worker_int)
+        self.cfg.set('worker_exit', self.worker_exit)
+
+    def load(self):
+        if self.application is None:
+            self.application = self.app_factory()
+            warm_up(self.application)
+
+            # Connections opened during the warm-up must not be shared by the forked workers.
+            dispose_connections(self.application)
+
+        return self.application
+
+    def post_fork(self, server, worker):
+        handle_exit = worker.handle_exit
+
+        def drain(sig, frame):
+            # TERM (also sent to the old workers on HUP) drains in-flight requests, and gunicorn has no hook for it, so stop reporting the worker as ready here.
+            self.application.extensions['trivia_ready'] = False
+            handle_exit(sig, frame)
+
+        # The worker installs its signal handlers after the fork, so it picks up this one.
+        worker.handle_exit = drain
+
+        start_background_workers(self.application)
+
+    def worker_int(self, worker):
+        # The worker is shutting down on INT or QUIT, so stop reporting it as ready.
+        self.application.extensions['trivia_ready'] = False
+
+    def worker_exit(self, server, worker):
+        self.application.extensions['trivia_ready'] = False
+        stop_background_workers(self.application)
+
+
+def main():
+    TriviaServer().run()
+
+
+if __name__ == '__main__':
+    main()
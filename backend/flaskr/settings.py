@@ -0,0 +1,28 @@
+import os
+
+
+def get_setting(app, key, default=None, cast=str):
+    """
+    A helper function which reads a setting from the app config, falling back to an environment variable of the same name and then to the default.
+
+    Args:
+        app: The flask application.
+        key: The name of the setting, e.g. 'QUIZ_BUFFER_DEPTH'.
+        default: The value returned when the setting is not configured anywhere.
+        cast: A callable used to convert values read from the environment, which are always strings. Booleans are parsed from 'true'/'false' style strings.
+
+    Returns:
+        The value of the setting.
+    """
+    if key in app.config:
+        return app.config[key]
+
+    value = os.getenv(key)
+
+    if value is None:
+        return default
+
+    if cast is bool:
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+    return cast(value)
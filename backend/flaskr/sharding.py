@@ -0,0 +1,272 @@
+import os
+import json
+import heapq
+from itertools import islice
+
+from sqlalchemy import create_engine, func, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from models import db, Question, QuestionId
+
+# The name of the shard backed by the app's own database (SQLALCHEMY_DATABASE_URI).
+# Categories which are not present in the category-to-shard map are stored here.
+DEFAULT_SHARD = 'default'
+
+
+def load_shard_config(app):
+    """
+    A helper function which reads the sharding configuration from the app config, falling back to environment variables.
+
+    Both settings are JSON objects. TRIVIA_SHARDS maps a shard name to a database URI and TRIVIA_CATEGORY_SHARDS maps a category id to a shard name.
+
+    Sample configuration:
+        TRIVIA_SHARDS='{"shard_a": "sqlite:///shard_a.db", "shard_b": "postgresql://localhost:5432/trivia_b"}'
+        TRIVIA_CATEGORY_SHARDS='{"1": "shard_a", "2": "shard_a", "6": "shard_b"}'
+
+    Args:
+        app: The flask application.
+
+    Returns:
+        A tuple of (shard_uris, category_shards).
+    """
+    shard_uris = app.config.get('TRIVIA_SHARDS')
+    if shard_uris is None:
+        shard_uris = json.loads(os.getenv('TRIVIA_SHARDS', '{}'))
+
+    category_shards = app.config.get('TRIVIA_CATEGORY_SHARDS')
+    if category_shards is None:
+        category_shards = json.loads(os.getenv('TRIVIA_CATEGORY_SHARDS', '{}'))
+
+    return shard_uris, category_shards
+
+
+class ShardRouter:
+    """
+    Routes queries against the questions table to the database which owns the category of the questions.
+
+    Every shard holds a complete 'questions' table but only stores rows for the categories mapped to it. The 'categories' table, and any other table, stays on the default database.
+
+    Per-category queries go straight to the owning shard, while cross-category queries (pagination, search, lookups by id) fan out to every shard and merge the results.
+
+    Every shard numbers its rows independently, so when there are several shards question ids are allocated from the 'question_ids' table on the app database instead, which keeps them unique across shards.
+    """
+
+    def __init__(self, shard_uris=None, category_shards=None):
+        shard_uris = shard_uris or {}
+        category_shards = category_shards or {}
+
+        if DEFAULT_SHARD in shard_uris:
+            raise ValueError(
+                f"'{DEFAULT_SHARD}' is reserved for the app database and cannot be used as a shard name.")
+
+        self.sessions = {DEFAULT_SHARD: db.session}
+        self.engines = {}
+
+        for shard_name, uri in shard_uris.items():
+            engine = create_engine(uri)
+            Question.__table__.create(bind=engine, checkfirst=True)
+
+            self.engines[shard_name] = engine
+            self.sessions[shard_name] = scoped_session(
+                sessionmaker(bind=engine))
+
+        self.category_shards = {}
+
+        for category_id, shard_name in category_shards.items():
+            if shard_name not in self.sessions:
+                raise ValueError(
+                    f"Category {category_id} is mapped to the unknown shard '{shard_name}'.")
+            self.category_shards[int(category_id)] = shard_name
+
+        self.id_allocator_seeded = False
+
+    @property
+    def is_sharded(self):
+        return len(self.sessions) > 1
+
+    def shard_for_category(self, category_id):
+        """
+        Returns the name of the shard which stores the questions for the given category.
+        """
+        try:
+            return self.category_shards.get(int(category_id), DEFAULT_SHARD)
+        except (TypeError, ValueError):
+            return DEFAULT_SHARD
+
+    def session_for_category(self, category_id):
+        """
+        Returns the session bound to the shard which stores the questions for the given category.
+        """
+        return self.sessions[self.shard_for_category(category_id)]
+
+    def all_sessions(self):
+        """
+        Returns a list containing the session for every shard, starting with the default shard.
+        """
+        return list(self.sessions.values())
+
+    def query_for_category(self, category_id):
+        """
+        Returns a query for the questions of a single category, issued against the owning shard only.
+        """
+        session = self.session_for_category(category_id)
+
+        return session.query(Question).filter(Question.category == category_id)
+
+    def get_question(self, question_id):
+        """
+        Looks up a question by id on every shard.
+
+        Args:
+            question_id: The id of the question.
+
+        Returns:
+            A tuple of (session, question) for the shard on which the question was found, or (None, None) if no shard has it.
+        """
+        for session in self.all_sessions():
+            question = session.query(Question).get(question_id)
+
+            if question is not None:
+                return session, question
+
+        return None, None
+
+    def seed_id_allocator(self):
+        """
+        Moves the id allocator past the highest question id on any shard, e.g. the ids of questions which were stored before the question bank was sharded.
+        """
+        highest_id = max(session.query(func.max(Question.id)).scalar() or 0
+                         for session in self.all_sessions())
+
+        if highest_id > 0:
+            if db.session.bind.dialect.name == 'postgresql':
+                db.session.execute(text(
+                    "SELECT setval('question_ids_id_seq', GREATEST(:highest_id, (SELECT last_value FROM question_ids_id_seq)))"),
+                    {"highest_id": highest_id})
+            else:
+                # With AUTOINCREMENT, SQLite never hands out an id below the highest one ever inserted.
+                allocation = QuestionId(id=highest_id)
+                db.session.add(allocation)
+                db.session.flush()
+                db.session.delete(allocation)
+
+            db.session.commit()
+
+        self.id_allocator_seeded = True
+
+    def allocate_question_id(self):
+        """
+        Returns a new question id which is unique across every shard.
+        """
+        if not self.id_allocator_seeded:
+            self.seed_id_allocator()
+
+        allocation = QuestionId()
+        db.session.add(allocation)
+        db.session.flush()
+
+        question_id = allocation.id
+
+        db.session.delete(allocation)
+        db.session.commit()
+
+        return question_id
+
+    def write(self, session, question, write, record=None):
+        """
+        Makes a write on a shard and commits it.
+
+        Args:
+            session: The session of the shard.
+            question: The question which is written.
+            write: A function which makes the write on the session.
+            record: (Optional) A function which records the write in the change log on the app database, given the question and a function which makes the write there (or None if it has already been committed). On the app database the write and its change commit in one transaction. On any other shard the write commits first, and is recorded afterwards.
+        """
+        if record is not None and session is db.session:
+            record(question, write)
+            return
+
+        write()
+        session.commit()
+
+        if record is not None:
+            record(question, None)
+
+    def add_question(self, question, record=None):
+        """
+        Inserts a question into the shard which owns its category and commits it, together with its change if a record function is given (see write()).
+        """
+        if self.is_sharded:
+            question.id = self.allocate_question_id()
+
+        session = self.session_for_category(question.category)
+        self.write(session, question, lambda: session.add(question), record)
+
+    def delete_question(self, question_id, record=None):
+        """
+        Deletes the question with the given id from whichever shard stores it, together with its change if a record function is given (see write()).
+
+        Returns:
+            The deleted question, or None if it does not exist on any shard.
+        """
+        session, question = self.get_question(question_id)
+
+        if question is None:
+            return None
+
+        self.write(session, question, lambda: session.delete(question), record)
+
+        return question
+
+    def paginate(self, page, per_page, options=()):
+        """
+        Returns one page of questions ordered by id.
+
+        With a single database this is a plain OFFSET/LIMIT query. With several shards every shard returns its first page * per_page questions, and the sorted streams are merged with a k-way merge before the requested page is sliced off.
+
+        Args:
+            page: The 1-based page number.
+            per_page: The number of questions per page.
+            options: (Optional) Query options, e.g. load_only() to limit the columns which are selected.
+
+        Returns:
+            A list of objects which are instances of the 'Question' class/data model.
+        """
+        page = max(page, 1)
+        offset = (page - 1) * per_page
+
+        if not self.is_sharded:
+            return db.session.query(Question).options(*options).order_by(
+                Question.id).offset(offset).limit(per_page).all()
+
+        streams = [session.query(Question).options(*options).order_by(Question.id).limit(offset + per_page).all()
+                   for session in self.all_sessions()]
+
+        merged = heapq.merge(*streams, key=lambda question: question.id)
+
+        return list(islice(merged, offset, offset + per_page))
+
+    def search(self, search_query, options=()):
+        """
+        Returns every question, across all shards, whose text contains the search query in a case-insensitive manner, ordered by id.
+        """
+        streams = [session.query(Question).options(*options).filter(
+            Question.question.ilike(f"%{search_query}%")).order_by(Question.id).all()
+            for session in self.all_sessions()]
+
+        return list(heapq.merge(*streams, key=lambda question: question.id))
+
+    def rollback(self):
+        for session in self.all_sessions():
+            session.rollback()
+
+    def close(self):
+        for session in self.all_sessions():
+            session.close()
+
+    def remove(self, exception=None):
+        """
+        Disposes of the scoped session of every shard. Registered as an app context teardown function.
+        """
+        for session in self.all_sessions():
+            session.remove()
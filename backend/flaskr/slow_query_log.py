@@ -0,0 +1,149 @@
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+from collections import deque
+
+from flask import request, has_request_context
+from sqlalchemy import event
+
+# The statements used to fetch a query plan, by database dialect.
+EXPLAIN_PREFIXES = {
+    'postgresql': ('EXPLAIN ', 'EXPLAIN ANALYZE '),
+    'sqlite': ('EXPLAIN QUERY PLAN ', 'EXPLAIN QUERY PLAN '),
+}
+
+
+def _json_safe(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _json_safe(item) for key, item in value.items()}
+    return repr(value)
+
+
+class SlowQueryLog:
+    """
+    Records every SQL statement which runs for longer than a threshold, together with its parameters, the route which issued it and its query plan.
+
+    The entries are kept in a bounded in-memory ring, so the log never grows past 'capacity' entries. Query plans are only captured for SELECT statements, since EXPLAIN ANALYZE executes the statement a second time.
+    """
+
+    def __init__(self, threshold_ms=100, capacity=100, explain=True, analyze=False, redact_parameters=False):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.analyze = analyze
+        self.redact_parameters = redact_parameters
+
+        self.entries = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+
+    def attach(self, engine):
+        """
+        Registers the timing hooks on a SQLAlchemy engine.
+        """
+        event.listen(engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # The start time lives on the execution context rather than the connection, since after_cursor_execute is not called for a statement which fails. Only the probes the dialect runs on a new connection have no context, and they are not timed.
+        if context is not None:
+            context.slow_query_start_time = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_time = getattr(context, 'slow_query_start_time', None)
+
+        if start_time is None:
+            return
+
+        duration_ms = (time.perf_counter() - start_time) * 1000
+
+        if duration_ms < self.threshold_ms:
+            return
+
+        plan = None
+        # Drivers such as psycopg2 bind the parameters on the client, so they show up as literals in the plan. Redacted entries leave the plan out.
+        if self.explain and not self.redact_parameters and not executemany and statement.lstrip().upper().startswith('SELECT'):
+            plan = self.explain_statement(conn, statement, parameters)
+
+        if self.redact_parameters:
+            parameters = '<redacted>'
+
+        entry = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "duration_ms": round(duration_ms, 3),
+            "database": repr(conn.engine.url),
+            "route": request.endpoint if has_request_context() else None,
+            "statement": statement,
+            "parameters": _json_safe(parameters),
+            "plan": plan
+        }
+
+        with self.lock:
+            self.entries.append(entry)
+
+    def explain_statement(self, conn, statement, parameters):
+        """
+        Returns the query plan of a statement as a list of strings.
+
+        The plan is fetched through a separate DBAPI cursor, which bypasses the SQLAlchemy events and leaves the results of the original cursor untouched. On Postgres the EXPLAIN runs inside a savepoint so that a failure cannot abort the transaction of the request.
+        """
+        prefixes = EXPLAIN_PREFIXES.get(conn.dialect.name)
+
+        if prefixes is None:
+            return None
+
+        explain = prefixes[1] if self.analyze else prefixes[0]
+        use_savepoint = conn.dialect.name == 'postgresql'
+        cursor = conn.connection.cursor()
+
+        try:
+            if use_savepoint:
+                cursor.execute('SAVEPOINT slow_query_explain')
+
+            cursor.execute(explain + statement, parameters)
+            plan = [' '.join(str(column) for column in row)
+                    for row in cursor.fetchall()]
+
+            if use_savepoint:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+
+            return plan
+
+        except:
+            if use_savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return [f"EXPLAIN failed: {sys.exc_info()[1]}"]
+
+        finally:
+            cursor.close()
+
+    def list_entries(self):
+        """
+        Returns the recorded entries, oldest first.
+        """
+        with self.lock:
+            return list(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def dump(self, path):
+        """
+        Appends the recorded entries to a file, one JSON object per line.
+
+        Returns:
+            The number of entries written.
+        """
+        entries = self.list_entries()
+
+        with open(path, 'a') as dump_file:
+            for entry in entries:
+                dump_file.write(json.dumps(entry) + '\n')
+
+        return len(entries)
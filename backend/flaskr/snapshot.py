@@ -0,0 +1,405 @@
+import os
+import sys
+import mmap
+import heapq
+import random
+import struct
+import fcntl
+import tempfile
+import threading
+from array import array
+
+from sqlalchemy import distinct
+
+from models import Question, Category, QUESTION_FIELDS
+
+# Snapshot file layout (integers in native byte order, every section aligned to 8 bytes).
+# Snapshots are only shared between processes on one host, so they are never byte-swapped.
+#
+#   header                 magic, version, question_count (n), category_count (m), range_count (r)
+#   question_ids           int32[n]    question rows sorted by (category, id)
+#   question_categories    int32[n]
+#   question_difficulties  int32[n]
+#   id_order               uint32[n]   row numbers sorted by question id
+#   question_offsets       uint64[n+1] offsets of the question texts in the text blob
+#   answer_offsets         uint64[n+1] offsets of the answer texts in the text blob
+#   category_ids           int32[m]    rows of the categories table sorted by id
+#   category_offsets       uint64[m+1] offsets of the category types in the text blob
+#   range_categories       int32[r]    every category which has questions, sorted
+#   range_starts           uint32[r]   first question row of the category
+#   range_ends             uint32[r]   one past the last question row of the category
+#   text blob              utf-8
+MAGIC = b'TRIVSNAP'
+HEADER = struct.Struct('<8sQIII4x')
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _layout(question_count, category_count, range_count):
+    """
+    Returns a list of (section_name, typecode, length, offset) tuples describing where every array of a snapshot lives, followed by the offset of the text blob.
+    """
+    sections = [
+        ('question_ids', 'i', question_count),
+        ('question_categories', 'i', question_count),
+        ('question_difficulties', 'i', question_count),
+        ('id_order', 'I', question_count),
+        ('question_offsets', 'Q', question_count + 1),
+        ('answer_offsets', 'Q', question_count + 1),
+        ('category_ids', 'i', category_count),
+        ('category_offsets', 'Q', category_count + 1),
+        ('range_categories', 'i', range_count),
+        ('range_starts', 'I', range_count),
+        ('range_ends', 'I', range_count),
+    ]
+
+    layout = []
+    offset = _align(HEADER.size)
+
+    for name, typecode, length in sections:
+        layout.append((name, typecode, length, offset))
+        offset = _align(offset + length * array(typecode).itemsize)
+
+    return layout, offset
+
+
+class QuestionSnapshot:
+    """
+    A read-only, memory-mapped view of the question bank.
+
+    Every worker process which maps the same file shares one copy of it in the page cache. The fixed-width arrays are exposed as typed memoryviews over the mapping, so nothing is copied until a question is formatted for a response.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self.inode = os.fstat(snapshot_file.fileno()).st_ino
+            self.buffer = mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(self.buffer)
+        magic, self.version, question_count, category_count, range_count = HEADER.unpack_from(
+            self.buffer)
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a question bank snapshot.")
+
+        layout, blob_offset = _layout(
+            question_count, category_count, range_count)
+
+        for name, typecode, length, offset in layout:
+            itemsize = array(typecode).itemsize
+            setattr(self, name, view[offset:offset +
+                                     length * itemsize].cast(typecode))
+
+        self.blob = view[blob_offset:]
+        self.question_count = question_count
+
+    def _text(self, offsets, index):
+        return str(self.blob[offsets[index]:offsets[index + 1]], 'utf-8')
+
+    def question(self, row, fields=None):
+        """
+        Returns the question stored in the given row as a dictionary, in the same shape as Question.format(). Texts which are not among the requested fields are never decoded.
+        """
+        question = {}
+
+        for field in fields or QUESTION_FIELDS:
+            if field == "id":
+                question[field] = self.question_ids[row]
+            elif field == "question":
+                question[field] = self._text(self.question_offsets, row)
+            elif field == "answer":
+                question[field] = self._text(self.answer_offsets, row)
+            elif field == "category":
+                question[field] = self.question_categories[row]
+            elif field == "difficulty":
+                question[field] = self.question_difficulties[row]
+
+        return question
+
+    def categories(self):
+        """
+        Returns a hash table of categories where each key:value pair represents the category id and the category type respectively.
+        """
+        return {self.category_ids[index]: self._text(self.category_offsets, index)
+                for index in range(len(self.category_ids))}
+
+    def category_type(self, category_id):
+        """
+        Returns the type of the given category, or None if it does not exist.
+        """
+        index = self._bisect(self.category_ids, category_id)
+
+        if index is None:
+            return None
+
+        return self._text(self.category_offsets, index)
+
+    def _bisect(self, sorted_values, value):
+        low, high = 0, len(sorted_values)
+
+        while low < high:
+            middle = (low + high) // 2
+            if sorted_values[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(sorted_values) and sorted_values[low] == value:
+            return low
+
+        return None
+
+    def _category_rows(self, category_id):
+        try:
+            index = self._bisect(self.range_categories, int(category_id))
+        except (TypeError, ValueError):
+            index = None
+
+        if index is None:
+            return range(0)
+
+        return range(self.range_starts[index], self.range_ends[index])
+
+    def paginate(self, page, per_page, fields=None):
+        """
+        Returns one page of questions ordered by id.
+        """
+        start = (max(page, 1) - 1) * per_page
+        rows = self.id_order[start:start + per_page]
+
+        return [self.question(row, fields) for row in rows]
+
+    def questions_for_category(self, category_id, fields=None):
+        """
+        Returns every question of the given category ordered by id.
+        """
+        return [self.question(row, fields) for row in self._category_rows(category_id)]
+
+    def search(self, search_query, fields=None):
+        """
+        Returns every question whose text contains the search query in a case-insensitive manner, ordered by id.
+        """
+        search_query = search_query.lower()
+
+        return [self.question(row, fields) for row in self.id_order
+                if search_query in self._text(self.question_offsets, row).lower()]
+
+    def quiz_question(self, category_id, previous_questions):
+        """
+        Returns a random question of the given category which is not in the list of previous questions, or None if there is none left.
+        """
+        excluded_ids = set(previous_questions)
+        rows = [row for row in self._category_rows(category_id)
+                if self.question_ids[row] not in excluded_ids]
+
+        if len(rows) == 0:
+            return None
+
+        return self.question(random.choice(rows))
+
+
+def _write_array(snapshot_file, offset, values):
+    snapshot_file.seek(offset)
+    values.tofile(snapshot_file)
+
+
+def write_snapshot(shards, path, version):
+    """
+    Writes a snapshot of the 'categories' table and the 'questions' table of every shard to the given path.
+
+    Questions are streamed from the database one category at a time, and their texts are spilled into a temporary file, so only the fixed-width arrays are held in memory.
+
+    Args:
+        shards: The ShardRouter which owns the Question table(s).
+        path: The path of the snapshot file. It is overwritten.
+        version: The version number stored in the snapshot header.
+    """
+    categories = Category.query.order_by(Category.id).all()
+
+    category_ids = set()
+    for session in shards.all_sessions():
+        category_ids.update(int(category_id) for (category_id,) in session.query(
+            distinct(Question.category)).all() if category_id is not None)
+
+    question_ids = array('i')
+    question_categories = array('i')
+    question_difficulties = array('i')
+    question_offsets = array('Q', [0])
+    answer_offsets = array('Q', [0])
+    range_categories = array('i')
+    range_starts = array('I')
+    range_ends = array('I')
+
+    with tempfile.TemporaryFile() as question_blob, tempfile.TemporaryFile() as answer_blob:
+        question_blob_length = 0
+        answer_blob_length = 0
+
+        for category_id in sorted(category_ids):
+            streams = [session.query(Question).filter(Question.category == category_id).order_by(
+                Question.id).yield_per(1000) for session in shards.all_sessions()]
+
+            range_categories.append(category_id)
+            range_starts.append(len(question_ids))
+
+            for question in heapq.merge(*streams, key=lambda question: question.id):
+                question_text = (question.question or '').encode('utf-8')
+                answer_text = (question.answer or '').encode('utf-8')
+
+                question_ids.append(question.id)
+                question_categories.append(category_id)
+                question_difficulties.append(question.difficulty or 0)
+
+                question_blob.write(question_text)
+                question_blob_length += len(question_text)
+                question_offsets.append(question_blob_length)
+
+                answer_blob.write(answer_text)
+                answer_blob_length += len(answer_text)
+                answer_offsets.append(answer_blob_length)
+
+            range_ends.append(len(question_ids))
+
+        # Answers are stored after the questions in the blob.
+        for index in range(len(answer_offsets)):
+            answer_offsets[index] += question_blob_length
+
+        category_text = b''
+        category_offsets = array('Q', [answer_offsets[-1]])
+        for category in categories:
+            category_text += (category.type or '').encode('utf-8')
+            category_offsets.append(answer_offsets[-1] + len(category_text))
+
+        # The rows of every category are already sorted by id, so a k-way merge of the category ranges yields the rows in id order without a Python object per row.
+        category_rows = [zip(map(question_ids.__getitem__, range(start, end)), range(start, end))
+                         for start, end in zip(range_starts, range_ends)]
+        id_order = array('I', (row for question_id, row in heapq.merge(*category_rows)))
+
+        arrays = {
+            'question_ids': question_ids,
+            'question_categories': question_categories,
+            'question_difficulties': question_difficulties,
+            'id_order': id_order,
+            'question_offsets': question_offsets,
+            'answer_offsets': answer_offsets,
+            'category_ids': array('i', [category.id for category in categories]),
+            'category_offsets': category_offsets,
+            'range_categories': range_categories,
+            'range_starts': range_starts,
+            'range_ends': range_ends,
+        }
+
+        layout, blob_offset = _layout(
+            len(question_ids), len(categories), len(range_categories))
+
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(MAGIC, version, len(question_ids),
+                                            len(categories), len(range_categories)))
+
+            for name, typecode, length, offset in layout:
+                _write_array(snapshot_file, offset, arrays[name])
+
+            snapshot_file.seek(blob_offset)
+            for blob in (question_blob, answer_blob):
+                blob.seek(0)
+                while True:
+                    chunk = blob.read(1 << 20)
+                    if not chunk:
+                        break
+                    snapshot_file.write(chunk)
+            snapshot_file.write(category_text)
+
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+
+class SnapshotStore:
+    """
+    Manages the snapshot file shared by every worker process.
+
+    Rebuilds write a new file next to the current one and atomically rename it over the old path, so readers never see a partial snapshot. Every worker notices the new inode on its next read and maps the new version, while requests which are still reading the old mapping finish undisturbed.
+
+    Rebuilds are serialized across processes with a lock file and debounced within a process, so a burst of writes results in one rebuild.
+    """
+
+    def __init__(self, app, shards, path, rebuild_delay=1.0):
+        self.app = app
+        self.shards = shards
+        self.path = path
+        self.rebuild_delay = rebuild_delay
+
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.rebuild_timer = None
+
+    def current(self):
+        """
+        Returns the latest snapshot, remapping the file if it was replaced since the last call, or None if there is no snapshot yet.
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+
+        snapshot = self.snapshot
+
+        if snapshot is None or snapshot.inode != inode:
+            with self.lock:
+                if self.snapshot is None or self.snapshot.inode != inode:
+                    self.snapshot = QuestionSnapshot(self.path)
+                snapshot = self.snapshot
+
+        return snapshot
+
+    def rebuild(self):
+        """
+        Regenerates the snapshot from the database and swaps it in.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+
+        with open(self.path + '.lock', 'w') as lock_file, self.app.app_context():
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                with open(self.path, 'rb') as snapshot_file:
+                    version = HEADER.unpack(snapshot_file.read(HEADER.size))[1] + 1
+            except (FileNotFoundError, struct.error):
+                version = 1
+
+            descriptor, temporary_path = tempfile.mkstemp(
+                dir=directory, suffix='.tmp')
+            os.close(descriptor)
+
+            try:
+                write_snapshot(self.shards, temporary_path, version)
+                os.replace(temporary_path, self.path)
+            except:
+                os.remove(temporary_path)
+                raise
+
+        return version
+
+    def schedule_rebuild(self):
+        """
+        Rebuilds the snapshot in a background thread after 'rebuild_delay' seconds, unless a rebuild is already pending.
+        """
+        with self.lock:
+            if self.rebuild_timer is not None and self.rebuild_timer.is_alive():
+                return
+
+            self.rebuild_timer = threading.Timer(
+                self.rebuild_delay, self._run_scheduled_rebuild)
+            self.rebuild_timer.daemon = True
+            self.rebuild_timer.start()
+
+    def _run_scheduled_rebuild(self):
+        # Writes which arrive while this rebuild is running schedule another one.
+        with self.lock:
+            self.rebuild_timer = None
+
+        try:
+            self.rebuild()
+        except:
+            print(sys.exc_info())
@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Text, Integer, Float, Index, create_engine
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -17,6 +17,9 @@ database_path = "postgresql://{}:{}@{}/{}".format(
 
 db = SQLAlchemy()
 
+# The attributes of a question which clients can select with the 'fields' query parameter.
+QUESTION_FIELDS = ("id", "question", "answer", "category", "difficulty")
+
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -63,14 +66,28 @@ class Question(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
-            "id": self.id,
-            "question": self.question,
-            "answer": self.answer,
-            "category": self.category,
-            "difficulty": self.difficulty,
-        }
+    def format(self, fields=None):
+        """
+        Returns the question as a dictionary, limited to the given attributes if a list of fields is passed.
+        """
+        return {field: getattr(self, field) for field in fields or QUESTION_FIELDS}
+
+
+"""
+QuestionId
+
+"""
+
+
+class QuestionId(db.Model):
+    __tablename__ = "question_ids"
+    # Ids must never be handed out twice, even though the allocation rows are deleted straight away.
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+
+    def __init__(self, id=None):
+        self.id = id
 
 
 """
@@ -90,3 +107,91 @@ class Category(db.Model):
 
     def format(self):
         return {"id": self.id, "type": self.type}
+
+
+"""
+QuizResult
+
+"""
+
+
+class QuizResult(db.Model):
+    __tablename__ = "quiz_results"
+    __table_args__ = (
+        Index("ix_quiz_results_category_score", "category", "score"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    player = Column(String)
+    category = Column(Integer)
+    score = Column(Integer)
+    total_questions = Column(Integer)
+    submitted_at = Column(Float)
+
+    def __init__(self, player, category, score, total_questions, submitted_at):
+        self.player = player
+        self.category = category
+        self.score = score
+        self.total_questions = total_questions
+        self.submitted_at = submitted_at
+
+    def format(self):
+        return {
+            "player": self.player,
+            "category": self.category,
+            "score": self.score,
+            "total_questions": self.total_questions,
+            "submitted_at": self.submitted_at,
+        }
+
+
+"""
+QuestionChange
+
+"""
+
+
+class QuestionChange(db.Model):
+    __tablename__ = "question_changes"
+    # Sequence numbers must never be reused, even after the latest change has been compacted away.
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    question_id = Column(Integer, index=True)
+    operation = Column(String)
+    category = Column(Integer)
+    payload = Column(Text)
+    changed_at = Column(Float, index=True)
+
+    def __init__(self, question_id, operation, category, payload, changed_at):
+        self.question_id = question_id
+        self.operation = operation
+        self.category = category
+        self.payload = payload
+        self.changed_at = changed_at
+
+    def format(self):
+        return {
+            "seq": self.seq,
+            "operation": self.operation,
+            "question_id": self.question_id,
+            "category": self.category,
+            "question": json.loads(self.payload) if self.payload is not None else None,
+            "changed_at": self.changed_at,
+        }
+
+
+"""
+ChangeLogWatermark
+
+"""
+
+
+class ChangeLogWatermark(db.Model):
+    __tablename__ = "change_log_watermark"
+
+    id = Column(Integer, primary_key=True)
+    seq = Column(Integer)
+
+    def __init__(self, seq):
+        self.seq = seq
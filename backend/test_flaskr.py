@@ -2,9 +2,19 @@ import os
 import unittest
 import json
 import random
+import shutil
+import signal
+import time
+import pstats
+import tempfile
 from flask_sqlalchemy import SQLAlchemy
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.difficulty_sampler import AliasTable
+from flaskr.invalidation import QueryCache
+from flaskr.profiling import parse_sample_routes
+from flaskr.lifecycle import warm_up, start_background_workers, stop_background_workers
+from flaskr.serve import TriviaServer
+from models import setup_db, Question, Category, QuizResult, QuestionChange, db
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -267,6 +277,1172 @@ class TriviaTestCase(unittest.TestCase):
         pass
 
 
+class SQLiteTestCase(unittest.TestCase):
+    """A base class for the test cases which run the app against SQLite databases in a temporary directory"""
+
+    def setUp(self):
+        """Create the temporary directory."""
+        self.directory = tempfile.mkdtemp()
+        self.apps = []
+
+    def tearDown(self):
+        """Stop the background threads of every app created by the test, then delete the temporary directory"""
+        for app in reversed(self.apps):
+            stop_background_workers(app)
+            app.extensions['trivia_shards'].remove()
+        shutil.rmtree(self.directory)
+
+    def create_test_app(self, config=None):
+        """Create an app backed by the SQLite database in the temporary directory, which is cleaned up after the test."""
+        app = create_app(dict(
+            {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{self.directory}/trivia.db"}, **(config or {})))
+        self.apps.append(app)
+        return app
+
+
+class ShardedTriviaTestCase(SQLiteTestCase):
+    """This class represents the trivia test case with questions partitioned across several SQLite shards"""
+
+    def setUp(self):
+        """Create a primary database and two shards in a temporary directory and map categories 1 and 2 to different shards."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "TRIVIA_SHARDS": {
+                "shard_a": f"sqlite:///{self.directory}/shard_a.db",
+                "shard_b": f"sqlite:///{self.directory}/shard_b.db"
+            },
+            "TRIVIA_CATEGORY_SHARDS": {"1": "shard_a", "2": "shard_b"}
+        })
+        self.client = self.app.test_client
+        self.shards = self.app.extensions['trivia_shards']
+
+        with self.app.app_context():
+            for category_type in ["Science", "Art", "Geography"]:
+                db.session.add(Category(type=category_type))
+            db.session.commit()
+
+    def post_question(self, question, category):
+        payload = {"question": question, "answer": "answer",
+                   "category": category, "difficulty": 1}
+        return self.client().post('/v1/questions', json=payload)
+
+    def test_success_questions_are_stored_in_owning_shard(self):
+        """A new question should be written to the shard which owns its category only"""
+
+        self.post_question("Which planet is the largest?", 1)
+        self.post_question("Who painted the Mona Lisa?", 2)
+        self.post_question("Which river is the longest?", 3)
+
+        shard_a = self.shards.sessions['shard_a']
+        shard_b = self.shards.sessions['shard_b']
+
+        self.assertEqual(shard_a.query(Question).count(), 1)
+        self.assertEqual(shard_b.query(Question).count(), 1)
+        self.assertEqual(db.session.query(Question).count(), 1)
+        pass
+
+    def test_success_get_questions_based_on_category_from_shard(self):
+        """A request for the questions of a category should return the questions stored on its shard"""
+
+        self.post_question("Who painted the Mona Lisa?", 2)
+
+        response_object = self.client().get('/v1/categories/2/questions')
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(response_data['total_questions'], 1)
+        self.assertEqual(response_data['current_category'], "Art")
+        pass
+
+    def test_success_paginated_questions_are_merged_across_shards(self):
+        """A paginated request should merge the questions of every shard in id order"""
+
+        for index in range(8):
+            self.post_question(f"Science question {index}", 1)
+            self.post_question(f"Art question {index}", 2)
+
+        first_page = json.loads(self.client().get(
+            '/v1/questions?page=1').get_data())['questions']
+        second_page = json.loads(self.client().get(
+            '/v1/questions?page=2').get_data())['questions']
+
+        ids = [question['id'] for question in first_page + second_page]
+
+        self.assertEqual(len(first_page), 10)
+        self.assertEqual(len(second_page), 6)
+        self.assertEqual(ids, list(range(1, 17)))
+        pass
+
+    def test_success_search_and_delete_across_shards(self):
+        """Search should fan out to every shard and delete should remove the question from the shard which stores it"""
+
+        self.post_question("Which planet has rings?", 1)
+        self.post_question("Which painter has one ear?", 2)
+
+        response_object = self.client().post(
+            '/v1/questions/search', json={"searchTerm": "WHICH"})
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_data['total_questions'], 2)
+
+        art_question_id = response_data['questions'][1]['id']
+        response_object = self.client().delete(
+            f"/v1/questions/{art_question_id}")
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(self.shards.sessions['shard_b'].query(
+            Question).filter(Question.id == art_question_id).count(), 0)
+        pass
+
+    def test_success_question_ids_are_unique_across_shards(self):
+        """Questions stored on different shards should never share an id, including ids stored before the first insert"""
+
+        existing_question = Question(question="Which gas do plants absorb?", answer="answer",
+                                     category=1, difficulty=1)
+        existing_question.id = 5
+        self.shards.sessions['shard_a'].add(existing_question)
+        self.shards.sessions['shard_a'].commit()
+
+        self.post_question("Which river is the longest?", 3)
+        self.post_question("Which planet is the largest?", 1)
+
+        questions = json.loads(self.client().get(
+            '/v1/questions').get_data())['questions']
+        ids = [question['id'] for question in questions]
+
+        self.assertEqual(ids, [5, 6, 7])
+
+        self.client().delete('/v1/questions/6')
+
+        self.assertEqual(db.session.query(Question).count(), 0)
+        self.assertEqual(
+            self.shards.sessions['shard_a'].query(Question).count(), 2)
+        pass
+
+
+class QuizBufferTestCase(SQLiteTestCase):
+    """This class represents the trivia test case with the quiz question buffers enabled"""
+
+    def setUp(self):
+        """Create a SQLite database with one category and a few questions, then fill the quiz buffers."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "QUIZ_BUFFER_ENABLED": True,
+            "QUIZ_BUFFER_DEPTH": 10,
+            "QUIZ_BUFFER_REFILL_INTERVAL": 60
+        })
+        self.client = self.app.test_client
+        self.quiz_buffer = self.app.extensions['trivia_quiz_buffer']
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            for index in range(3):
+                db.session.add(Question(question=f"Science question {index}", answer="answer",
+                                        category=1, difficulty=1))
+            db.session.commit()
+
+        self.quiz_buffer.refill()
+
+    def test_success_get_questions_to_play_quiz_from_buffer(self):
+        """A quiz request should be served from the buffer and skip the previous questions"""
+
+        payload = {"previous_questions": [1, 2],
+                   "quiz_category": {"type": "Science", "id": 1}}
+
+        response_object = self.client().post('/v1/quizzes', json=payload)
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(response_data['question']['id'], 3)
+        self.assertEqual(self.quiz_buffer.metrics()['hits'], 1)
+        pass
+
+    def test_success_get_questions_to_play_quiz_falls_back_to_database(self):
+        """A quiz request which the buffer cannot satisfy should be answered from the database"""
+
+        payload = {"previous_questions": [1, 2],
+                   "quiz_category": {"type": "Science", "id": 1}}
+
+        self.client().post('/v1/quizzes', json=payload)
+        response_object = self.client().post('/v1/quizzes', json=payload)
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(response_data['question']['id'], 3)
+        self.assertEqual(self.quiz_buffer.metrics()['misses'], 1)
+        pass
+
+    def wait_for_refills(self, quiz_buffer, refills):
+        deadline = time.time() + 5
+
+        while quiz_buffer.refills < refills and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_success_small_category_does_not_trigger_early_refills(self):
+        """Draining the buffer of a category with fewer questions than half the depth should not start a pass per request"""
+
+        # The pass of the refill thread and the one of setUp.
+        self.wait_for_refills(self.quiz_buffer, 2)
+
+        payload = {"previous_questions": [],
+                   "quiz_category": {"type": "Science", "id": 1}}
+
+        for attempt in range(20):
+            self.client().post('/v1/quizzes', json=payload)
+
+        time.sleep(0.1)
+
+        self.assertEqual(self.quiz_buffer.refills, 2)
+        self.assertEqual(self.quiz_buffer.metrics()['hits'], 3)
+        pass
+
+    def test_success_empty_buffer_triggers_early_refill(self):
+        """A miss on an empty buffer should start a pass right away when the category has more questions"""
+
+        app = self.create_test_app({
+            "QUIZ_BUFFER_ENABLED": True,
+            "QUIZ_BUFFER_DEPTH": 2,
+            "QUIZ_BUFFER_REFILL_INTERVAL": 60
+        })
+        quiz_buffer = app.extensions['trivia_quiz_buffer']
+        self.wait_for_refills(quiz_buffer, 1)
+
+        # The buffered questions are deleted, as if by another server process.
+        for question_id in [question['id'] for question in quiz_buffer.buffers[1]]:
+            quiz_buffer.discard(question_id)
+
+        self.assertIsNone(quiz_buffer.draw(1, []))
+        self.wait_for_refills(quiz_buffer, 2)
+
+        self.assertEqual(quiz_buffer.refills, 2)
+        self.assertEqual(len(quiz_buffer.buffers[1]), 2)
+        pass
+
+    def test_success_sample_questions_without_repeats(self):
+        """Sampling should return distinct questions of the category, leaving out the excluded ones"""
+
+        with self.app.app_context():
+            for attempt in range(10):
+                sampled_ids = [question.id for question in self.quiz_buffer.sample(1, [2], 5)]
+
+                self.assertEqual(sorted(sampled_ids), [1, 3])
+        pass
+
+    def test_success_get_metrics(self):
+        """A get request to the /v1/metrics endpoint should describe the quiz buffers"""
+
+        response_object = self.client().get('/v1/metrics')
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(response_data['quiz_buffer']['depth'], 10)
+        self.assertEqual(
+            response_data['quiz_buffer']['buffered_questions']['1'], 3)
+        pass
+
+    def test_success_drop_questions_deleted_by_other_worker(self):
+        """A question deleted through another server process should be dropped from the buffers by the next refill pass"""
+
+        other_app = self.create_test_app()
+        other_app.test_client().delete('/v1/questions/1')
+
+        self.quiz_buffer.refill()
+
+        payload = {"previous_questions": [2, 3],
+                   "quiz_category": {"type": "Science", "id": 1}}
+        response_data = json.loads(self.client().post(
+            '/v1/quizzes', json=payload).get_data())
+
+        self.assertIsNone(response_data['question'])
+        self.assertEqual(
+            self.quiz_buffer.metrics()['buffered_questions'][1], 2)
+        pass
+
+
+class SnapshotTestCase(SQLiteTestCase):
+    """This class represents the trivia test case with the read routes served from a memory-mapped snapshot"""
+
+    def setUp(self):
+        """Create a SQLite database with two categories and a few questions, then build the snapshot."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "SNAPSHOT_PATH": f"{self.directory}/questions.snapshot",
+            "SNAPSHOT_REBUILD_DELAY": 60
+        })
+        self.client = self.app.test_client
+        self.snapshots = self.app.extensions['trivia_snapshots']
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.add(Category(type="Art"))
+            db.session.add(Question(question="Which planet has rings?", answer="Saturn",
+                                    category=1, difficulty=2))
+            db.session.add(Question(question="Who painted the Mona Lisa?", answer="Leonardo da Vinci",
+                                    category=2, difficulty=3))
+            db.session.add(Question(question="Which planet is red?", answer="Mars",
+                                    category=1, difficulty=1))
+            db.session.commit()
+
+        self.snapshots.rebuild()
+
+    def test_success_read_routes_are_served_from_snapshot(self):
+        """The categories, questions, category and search routes should return the contents of the snapshot"""
+
+        categories = json.loads(self.client().get(
+            '/v1/categories').get_data())['categories']
+        questions = json.loads(self.client().get(
+            '/v1/questions').get_data())['questions']
+        category_response = json.loads(self.client().get(
+            '/v1/categories/1/questions').get_data())
+        search_results = json.loads(self.client().post(
+            '/v1/questions/search', json={"searchTerm": "PLANET"}).get_data())['questions']
+
+        self.assertEqual(categories, {"1": "Science", "2": "Art"})
+        self.assertEqual([question['id'] for question in questions], [1, 2, 3])
+        self.assertEqual(questions[1], {"id": 2, "question": "Who painted the Mona Lisa?",
+                                        "answer": "Leonardo da Vinci", "category": 2, "difficulty": 3})
+        self.assertEqual(category_response['current_category'], "Science")
+        self.assertEqual([question['id']
+                          for question in category_response['questions']], [1, 3])
+        self.assertEqual([question['id']
+                          for question in search_results], [1, 3])
+        pass
+
+    def test_success_get_paginated_questions_with_fields_from_snapshot(self):
+        """A request with the fields parameter should only return the requested attributes from the snapshot"""
+
+        questions = json.loads(self.client().get(
+            '/v1/questions?fields=id,category').get_data())['questions']
+
+        self.assertEqual(questions[0], {"id": 1, "category": 1})
+        pass
+
+    def test_404_get_questions_based_on_category_from_snapshot(self):
+        """A request to get questions from a category which is not in the snapshot should return a 404"""
+
+        response_object = self.client().get('/v1/categories/9999/questions')
+
+        self.assertEqual(response_object.status_code, 404)
+        pass
+
+    def test_success_snapshot_version_swap(self):
+        """Rebuilding the snapshot after a write should swap in a new version which includes the write"""
+
+        old_version = self.snapshots.current().version
+
+        self.client().post('/v1/questions', json={"question": "Which planet is largest?", "answer": "Jupiter",
+                                                  "category": 1, "difficulty": 1})
+        self.snapshots.rebuild()
+
+        payload = {"previous_questions": [1, 3],
+                   "quiz_category": {"type": "Science", "id": "1"}}
+        response_data = json.loads(self.client().post(
+            '/v1/quizzes', json=payload).get_data())
+
+        self.assertEqual(self.snapshots.current().version, old_version + 1)
+        self.assertEqual(response_data['question']['id'], 4)
+        pass
+
+
+class SlowQueryLogTestCase(SQLiteTestCase):
+    """This class represents the trivia test case with the slow-query log enabled and a threshold which flags every statement"""
+
+    def setUp(self):
+        """Create a SQLite database with one category."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "SLOW_QUERY_LOG_ENABLED": True,
+            "SLOW_QUERY_THRESHOLD_MS": 0,
+            "SLOW_QUERY_DUMP_PATH": f"{self.directory}/slow_queries.jsonl",
+            "ADMIN_TOKEN": "secret"
+        })
+        self.client = self.app.test_client
+        self.headers = {"Authorization": "Bearer secret"}
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.commit()
+
+        self.app.extensions['trivia_slow_query_log'].clear()
+
+    def test_success_get_slow_queries(self):
+        """A statement slower than the threshold should be recorded with its route and query plan"""
+
+        self.client().get('/v1/categories/1/questions')
+
+        response_object = self.client().get(
+            '/v1/admin/slow-queries', headers=self.headers)
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+
+        slow_query = response_data['slow_queries'][0]
+
+        self.assertEqual(slow_query['route'], 'get_questions_by_category')
+        self.assertIn('categories', slow_query['statement'])
+        self.assertEqual(type(slow_query['plan']), list)
+        pass
+
+    def test_success_get_slow_queries_with_redacted_parameters(self):
+        """With redaction on, neither the parameters nor the query plan, which can show them as literals, should be recorded"""
+
+        self.app.extensions['trivia_slow_query_log'].redact_parameters = True
+
+        self.client().post('/v1/questions/search',
+                           json={"searchTerm": "secret term"})
+
+        response_data = json.loads(self.client().get(
+            '/v1/admin/slow-queries', headers=self.headers).get_data())
+        slow_query = [entry for entry in response_data['slow_queries']
+                      if 'FROM questions' in entry['statement']][0]
+
+        self.assertEqual(slow_query['parameters'], '<redacted>')
+        self.assertIsNone(slow_query['plan'])
+        self.assertNotIn('secret term', json.dumps(response_data))
+        pass
+
+    def test_success_failed_statements_leave_no_state_on_connection(self):
+        """A statement which fails should not leave its start time behind on the pooled connection"""
+
+        with self.app.app_context():
+            connection = db.engine.connect()
+
+            for attempt in range(5):
+                with self.assertRaises(Exception):
+                    connection.execute('SELECT * FROM missing_table')
+
+            connection.execute('SELECT 1')
+
+            self.assertEqual(dict(connection.info), {})
+            connection.close()
+
+        statements = [entry['statement'] for entry in self.app.extensions['trivia_slow_query_log'].list_entries()]
+
+        self.assertIn('SELECT 1', statements)
+        pass
+
+    def test_401_get_slow_queries_without_admin_token(self):
+        """A request to the slow-query log without the admin token should return a 401"""
+
+        response_object = self.client().get('/v1/admin/slow-queries')
+
+        self.assertEqual(response_object.status_code, 401)
+        pass
+
+    def test_success_dump_slow_queries(self):
+        """Dumping the slow-query log should write one JSON object per recorded statement"""
+
+        self.client().get('/v1/categories')
+
+        response_object = self.client().post(
+            '/v1/admin/slow-queries/dump', headers=self.headers)
+        response_data = json.loads(response_object.get_data())
+
+        with open(response_data['path']) as dump_file:
+            lines = dump_file.readlines()
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(len(lines), response_data['number_of_slow_queries'])
+        self.assertEqual(json.loads(lines[0])['route'],
+                         'get_available_categories')
+        pass
+
+
+class ProfilingTestCase(SQLiteTestCase):
+    """This class represents the trivia test case with on-demand request profiling enabled"""
+
+    def setUp(self):
+        """Create a SQLite database with one category and profile 1 in 2 requests to the categories endpoint."""
+        super().setUp()
+        self.profile_directory = f"{self.directory}/profiles"
+        self.app = self.create_test_app({
+            "PROFILING_ENABLED": True,
+            "PROFILE_DIR": self.profile_directory,
+            "PROFILE_SAMPLE_ROUTES": "get_available_categories:2",
+            "ADMIN_TOKEN": "secret"
+        })
+        self.client = self.app.test_client
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.commit()
+
+    def profiles(self):
+        if not os.path.isdir(self.profile_directory):
+            return []
+        return sorted(os.listdir(self.profile_directory))
+
+    def test_success_profile_request_with_pstats(self):
+        """An authorized request with the X-Profile header should write a pstats profile and its SQL timings"""
+
+        headers = {"Authorization": "Bearer secret", "X-Profile": "pstats"}
+        response_object = self.client().get(
+            '/v1/categories/1/questions', headers=headers)
+
+        profiles = self.profiles()
+        profile_path = [name for name in profiles if name.endswith('.prof')][0]
+        sql_path = [name for name in profiles if name.endswith('.sql.json')][0]
+
+        with open(f"{self.profile_directory}/{sql_path}") as sql_file:
+            sql_summary = json.load(sql_file)
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertIn('get_questions_by_category', profile_path)
+        self.assertGreater(pstats.Stats(
+            f"{self.profile_directory}/{profile_path}").total_calls, 0)
+        self.assertEqual(len(sql_summary['statements']), 2)
+        pass
+
+    def test_success_profile_request_with_speedscope(self):
+        """An authorized request with the profile query parameter should write a speedscope profile which includes the SQL statements"""
+
+        response_object = self.client().get('/v1/categories/1/questions?profile=speedscope',
+                                            headers={"Authorization": "Bearer secret"})
+
+        with open(f"{self.profile_directory}/{self.profiles()[0]}") as profile_file:
+            profile = json.load(profile_file)
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(profile['profiles'][0]['type'], 'sampled')
+        self.assertEqual(len(profile['profiles'][1]['events']), 4)
+        pass
+
+    def test_sample_routes_reject_rates_below_one(self):
+        """A sampling rate below 1 should be rejected when the setting is parsed, rather than fail every request to the route"""
+
+        self.assertEqual(parse_sample_routes("get_leaderboard:1, search_questions:10"),
+                         {"get_leaderboard": 1, "search_questions": 10})
+
+        for value in ("get_leaderboard:0", {"get_leaderboard": -1}):
+            with self.assertRaises(ValueError):
+                parse_sample_routes(value)
+        pass
+
+    def test_unauthorized_profile_request_is_not_profiled(self):
+        """A request with the X-Profile header but without the admin token should be served without being profiled"""
+
+        response_object = self.client().get(
+            '/v1/categories/1/questions', headers={"X-Profile": "pstats"})
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(self.profiles(), [])
+        pass
+
+    def test_success_sampled_route_profiles_one_in_n_requests(self):
+        """1 in N requests to a sampled route should be profiled"""
+
+        for index in range(4):
+            self.client().get('/v1/categories')
+
+        profiles = [name for name in self.profiles() if name.endswith('.prof')]
+
+        self.assertEqual(len(profiles), 2)
+        pass
+
+
+class LeaderboardTestCase(SQLiteTestCase):
+    """This class represents the trivia test case for quiz result submission and the leaderboards"""
+
+    def setUp(self):
+        """Create a SQLite database with one category and a leaderboard of size 2."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "LEADERBOARD_SIZE": 2,
+            "LEADERBOARD_FLUSH_INTERVAL": 60
+        })
+        self.client = self.app.test_client
+        self.leaderboard = self.app.extensions['trivia_leaderboard']
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.commit()
+
+    def submit_result(self, player, score, quiz_category=1):
+        payload = {"player": player, "quiz_category": quiz_category,
+                   "score": score, "total_questions": 5}
+        return self.client().post('/v1/quizzes/results', json=payload)
+
+    def test_success_get_leaderboard(self):
+        """The leaderboard of a category should hold its K best results, best first"""
+
+        self.submit_result("ada", 3)
+        self.submit_result("grace", 5)
+        self.submit_result("linus", 1)
+        self.submit_result("alan", 4, quiz_category=0)
+
+        response_object = self.client().get('/v1/leaderboard?category=1')
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual([entry['player'] for entry in response_data['leaderboard']],
+                         ["grace", "ada"])
+        self.assertEqual(response_data['leaderboard'][0]['rank'], 1)
+        pass
+
+    def test_success_quiz_results_are_flushed_in_batches(self):
+        """Submitted results should be written to the database by a flush and survive a refresh of the heaps"""
+
+        self.submit_result("ada", 3)
+        self.submit_result("grace", 5)
+
+        with self.app.app_context():
+            self.assertEqual(QuizResult.query.count(), 0)
+
+        self.assertEqual(self.leaderboard.flush(), 2)
+        self.leaderboard.refresh()
+
+        with self.app.app_context():
+            self.assertEqual(QuizResult.query.count(), 2)
+
+        self.assertEqual(self.leaderboard.top(1)[0]['player'], "grace")
+        pass
+
+    def test_success_refresh_only_after_writing_results(self):
+        """The background thread should refresh the heaps after a flush which wrote results, and not after empty flushes"""
+
+        app = self.create_test_app({
+            "LEADERBOARD_FLUSH_INTERVAL": 0.01,
+            "LEADERBOARD_REFRESH_INTERVAL": 60
+        })
+        leaderboard = app.extensions['trivia_leaderboard']
+
+        time.sleep(0.1)
+        refreshes_while_idle = leaderboard.refreshes
+
+        app.test_client().post('/v1/quizzes/results', json={"player": "ada", "quiz_category": 1,
+                                                            "score": 3, "total_questions": 5})
+        deadline = time.time() + 5
+
+        while leaderboard.refreshes == refreshes_while_idle and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(refreshes_while_idle, 1)
+        self.assertEqual(leaderboard.refreshes, 2)
+        self.assertEqual(leaderboard.results_flushed, 1)
+        pass
+
+    def test_400_failure_submit_quiz_result(self):
+        """A result with a score greater than the number of questions should return a 400 status code"""
+
+        response_object = self.submit_result("ada", 6)
+
+        self.assertEqual(response_object.status_code, 400)
+        pass
+
+    def test_400_submit_quiz_result_for_unknown_category(self):
+        """A result for a category which does not exist should return a 400 status code and never reach the leaderboards"""
+
+        response_object = self.submit_result("ada", 3, quiz_category=99999)
+
+        self.assertEqual(response_object.status_code, 400)
+        self.assertEqual(self.leaderboard.flush(), 0)
+        self.assertEqual(self.leaderboard.top(99999), [])
+        pass
+
+
+class PreloadedServerTestCase(SQLiteTestCase):
+    """This class represents the trivia test case for an app created by a preloading server, which warms it up and starts its background threads itself"""
+
+    def setUp(self):
+        """Create a SQLite database with one category and an app which defers its background threads."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "DEFER_BACKGROUND_WORKERS": True,
+            "QUIZ_BUFFER_ENABLED": True
+        })
+        self.client = self.app.test_client
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.add(Question(question="Which planet has rings?", answer="Saturn",
+                                    category=1, difficulty=2))
+            db.session.commit()
+
+    def test_503_readiness_before_warm_up(self):
+        """An app which has not been warmed up should not report ready, nor run any background thread"""
+
+        response_object = self.client().get('/v1/health/ready')
+
+        self.assertEqual(response_object.status_code, 503)
+        self.assertIsNone(self.app.extensions['trivia_leaderboard'].thread)
+        pass
+
+    def test_success_readiness_after_warm_up(self):
+        """Warming the app up should fill the quiz buffers and make the app report ready"""
+
+        warm_up(self.app)
+        start_background_workers(self.app)
+
+        response_object = self.client().get('/v1/health/ready')
+        metrics = json.loads(self.client().get('/v1/metrics').get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(metrics['quiz_buffer']['buffered_questions']['1'], 1)
+        self.assertTrue(self.app.extensions['trivia_leaderboard'].thread.is_alive())
+        pass
+
+    def test_503_readiness_while_draining(self):
+        """A worker which receives TERM should stop reporting ready while it drains its requests"""
+
+        class Worker:
+            alive = True
+
+            def handle_exit(self, sig, frame):
+                self.alive = False
+
+        server = TriviaServer(lambda: self.app, {"workers": 1, "threads": 1})
+        server.load()
+
+        worker = Worker()
+        server.post_fork(None, worker)
+        self.assertEqual(self.client().get('/v1/health/ready').status_code, 200)
+
+        worker.handle_exit(signal.SIGTERM, None)
+        response_object = self.client().get('/v1/health/ready')
+
+        self.assertEqual(response_object.status_code, 503)
+        self.assertFalse(worker.alive)
+        pass
+
+
+class SparseFieldsetsTestCase(SQLiteTestCase):
+    """This class represents the trivia test case for limiting question responses to the attributes requested with the fields parameter"""
+
+    def setUp(self):
+        """Create a SQLite database with one category and one question, and record every statement in the slow-query log."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "SLOW_QUERY_LOG_ENABLED": True,
+            "SLOW_QUERY_THRESHOLD_MS": 0,
+            "SLOW_QUERY_EXPLAIN": False
+        })
+        self.client = self.app.test_client
+        self.slow_query_log = self.app.extensions['trivia_slow_query_log']
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.add(Question(question="Which planet has rings?", answer="Saturn",
+                                    category=1, difficulty=2))
+            db.session.commit()
+
+        self.slow_query_log.clear()
+
+    def question_statements(self):
+        return [entry['statement'] for entry in self.slow_query_log.list_entries()
+                if 'FROM questions' in entry['statement']]
+
+    def test_success_get_paginated_questions_with_fields(self):
+        """A request with the fields parameter should only select and return the requested attributes"""
+
+        response_object = self.client().get('/v1/questions?fields=id,question')
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual(response_data['questions'], [
+                         {"id": 1, "question": "Which planet has rings?"}])
+        self.assertNotIn('questions.answer', self.question_statements()[0])
+        pass
+
+    def test_success_search_and_get_questions_based_on_category_with_fields(self):
+        """The search and category routes should honour the fields parameter"""
+
+        search_results = json.loads(self.client().post('/v1/questions/search?fields=answer',
+                                                       json={"searchTerm": "rings"}).get_data())['questions']
+        category_questions = json.loads(self.client().get(
+            '/v1/categories/1/questions?fields=difficulty').get_data())['questions']
+
+        self.assertEqual(search_results, [{"answer": "Saturn"}])
+        self.assertEqual(category_questions, [{"difficulty": 2}])
+        self.assertNotIn('questions.question,', self.question_statements()[-1])
+        pass
+
+    def test_400_get_paginated_questions_with_unknown_field(self):
+        """A request for an attribute which questions do not have should return a 400 status code"""
+
+        response_object = self.client().get('/v1/questions?fields=id,secret')
+
+        self.assertEqual(response_object.status_code, 400)
+        pass
+
+
+class ChangeFeedTestCase(SQLiteTestCase):
+    """This class represents the trivia test case for the incremental change feed"""
+
+    def setUp(self):
+        """Create a SQLite database with one category and no questions."""
+        super().setUp()
+        self.app = self.create_test_app({
+            "CHANGE_FEED_RETENTION": 0
+        })
+        self.client = self.app.test_client
+        self.change_feed = self.app.extensions['trivia_change_feed']
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.commit()
+
+    def post_question(self, question):
+        self.client().post('/v1/questions', json={"question": question, "answer": "Saturn",
+                                                  "category": 1, "difficulty": 2})
+
+    def test_success_get_changes_since_sequence_number(self):
+        """Inserts and deletes should be returned in order, starting after the given sequence number"""
+
+        self.post_question("Which planet has rings?")
+        self.post_question("Which planet is the largest?")
+        self.client().delete('/v1/questions/1')
+
+        response_object = self.client().get('/v1/changes?since=1')
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual([(change['seq'], change['operation'], change['question_id'])
+                          for change in response_data['changes']], [(2, 'insert', 2), (3, 'delete', 1)])
+        self.assertEqual(
+            response_data['changes'][0]['question']['question'], "Which planet is the largest?")
+        self.assertIsNone(response_data['changes'][1]['question'])
+        self.assertEqual(response_data['latest_seq'], 3)
+        self.assertFalse(response_data['has_more'])
+        pass
+
+    def test_500_question_is_not_stored_without_its_change(self):
+        """A question should only be stored if its change is recorded in the same transaction"""
+
+        with self.app.app_context():
+            QuestionChange.__table__.drop(db.engine)
+
+        response_object = self.client().post('/v1/questions', json={"question": "Which planet has rings?", "answer": "Saturn",
+                                                                    "category": 1, "difficulty": 2})
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_data['error'], 500)
+
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), 0)
+        pass
+
+    def test_success_get_changes_with_limit(self):
+        """A limited request should report that more changes are waiting"""
+
+        self.post_question("Which planet has rings?")
+        self.post_question("Which planet is the largest?")
+
+        response_data = json.loads(self.client().get(
+            '/v1/changes?since=0&limit=1').get_data())
+
+        self.assertEqual([change['seq']
+                          for change in response_data['changes']], [1])
+        self.assertEqual(response_data['latest_seq'], 1)
+        self.assertTrue(response_data['has_more'])
+        pass
+
+    def test_success_get_changes_since_negative_sequence_number(self):
+        """A negative sequence number should be treated as 0 rather than as compacted away"""
+
+        self.post_question("Which planet has rings?")
+
+        response_object = self.client().get('/v1/changes?since=-1')
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 200)
+        self.assertEqual([change['seq']
+                          for change in response_data['changes']], [1])
+        pass
+
+    def test_410_get_changes_after_compaction(self):
+        """Compaction should drop tombstones, keep the latest change of every question, and make older sequence numbers resync"""
+
+        self.post_question("Which planet has rings?")
+        self.post_question("Which planet is the largest?")
+        self.client().delete('/v1/questions/1')
+
+        self.assertEqual(self.change_feed.compact(), 2)
+
+        response_object = self.client().get('/v1/changes?since=0')
+        response_data = json.loads(response_object.get_data())
+
+        self.assertEqual(response_object.status_code, 410)
+        self.assertEqual(response_data['latest_seq'], 3)
+
+        resynced_data = json.loads(self.client().get(
+            '/v1/changes?since=3').get_data())
+
+        self.assertEqual(resynced_data['changes'], [])
+        self.assertEqual(resynced_data['latest_seq'], 3)
+        pass
+
+
+class InvalidationBusTestCase(SQLiteTestCase):
+    """This class represents the trivia test case for caching queries across worker processes with the invalidation bus"""
+
+    def setUp(self):
+        """Create two apps, standing in for two worker processes, which share a SQLite database and a socket directory."""
+        super().setUp()
+        self.config = {
+            "INVALIDATION_BUS_ENABLED": True,
+            "INVALIDATION_SOCKET_DIR": f"{self.directory}/invalidation",
+            "INVALIDATION_POLL_INTERVAL": 0.05
+        }
+        self.app = self.create_test_app(self.config)
+
+        with self.app.app_context():
+            db.session.add(Category(type="Science"))
+            db.session.add(Question(question="Which planet has rings?", answer="Saturn",
+                                    category=1, difficulty=2))
+            db.session.commit()
+
+        self.other_app = self.create_test_app(self.config)
+
+    def wait_for_version(self, app, version):
+        bus = app.extensions['trivia_invalidation_bus']
+        deadline = time.time() + 5
+
+        while bus.version < version and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_success_invalidate_cached_questions_in_other_worker(self):
+        """A question added through one worker should invalidate the cached category questions of every worker"""
+
+        first_response = json.loads(self.other_app.test_client().get(
+            '/v1/categories/1/questions').get_data())
+        cached_response = json.loads(self.other_app.test_client().get(
+            '/v1/categories/1/questions').get_data())
+
+        self.app.test_client().post('/v1/questions', json={"question": "Which planet is the largest?", "answer": "Jupiter",
+                                                           "category": 1, "difficulty": 3})
+        self.wait_for_version(self.other_app, 1)
+
+        fresh_response = json.loads(self.other_app.test_client().get(
+            '/v1/categories/1/questions').get_data())
+        metrics = self.other_app.extensions['trivia_invalidation_bus'].metrics()
+
+        self.assertEqual(first_response['total_questions'], 1)
+        self.assertEqual(cached_response['total_questions'], 1)
+        self.assertEqual(fresh_response['total_questions'], 2)
+        # The categories stay cached, since only the questions of category 1 changed.
+        self.assertEqual((metrics['hits'], metrics['misses']), (3, 3))
+        self.assertEqual(metrics['events_applied'], 1)
+        pass
+
+    def test_success_apply_events_in_version_order(self):
+        """Events which were seen before should be ignored, and an event which skips a version should drop the whole cache"""
+
+        bus = self.other_app.extensions['trivia_invalidation_bus']
+        cache = self.other_app.extensions['trivia_query_cache']
+
+        cache.get(('categories', None), 'all', lambda: {1: "Science"})
+        cache.get(('questions', 2), 'all', lambda: [])
+
+        bus.apply({"table": "questions", "category": 1,
+                   "first_version": 1, "version": 1})
+        bus.apply({"table": "questions", "category": 1,
+                   "first_version": 1, "version": 1})
+
+        self.assertEqual(cache.metrics()['cached_results'], 2)
+        self.assertEqual(bus.events_skipped, 1)
+
+        bus.apply({"table": "questions", "category": 1,
+                   "first_version": 3, "version": 3})
+
+        self.assertEqual(cache.metrics()['cached_results'], 0)
+        self.assertEqual(bus.version, 3)
+        pass
+
+    def test_success_clear_cache_after_losing_last_event(self):
+        """A worker which misses the last event should drop its cache once no event arrives within the poll interval"""
+
+        self.other_app.test_client().get('/v1/categories/1/questions')
+
+        # Record the change without broadcasting it, as if its event had been lost.
+        self.app.extensions['trivia_change_feed'].bus = None
+        self.app.test_client().post('/v1/questions', json={"question": "Which planet is the largest?", "answer": "Jupiter",
+                                                           "category": 1, "difficulty": 3})
+        self.wait_for_version(self.other_app, 1)
+
+        fresh_response = json.loads(self.other_app.test_client().get(
+            '/v1/categories/1/questions').get_data())
+
+        self.assertEqual(fresh_response['total_questions'], 2)
+        self.assertEqual(
+            self.other_app.extensions['trivia_invalidation_bus'].events_applied, 0)
+        pass
+
+    def test_success_evict_least_recently_used_result(self):
+        """A full cache should evict the least recently used result, and empty pages should not be cached"""
+
+        cache = QueryCache(max_entries=2)
+
+        cache.get(('questions', 1), 'all', lambda: ["first"])
+        cache.get(('questions', 2), 'all', lambda: ["second"])
+        cache.get(('questions', 1), 'all', lambda: ["reloaded"])
+        cache.get(('questions', 3), 'all', lambda: ["third"])
+        cache.get(('questions', None), ('page', 100), lambda: [], cache_empty=False)
+
+        self.assertEqual(cache.get(('questions', 1), 'all', lambda: ["reloaded"]), ["first"])
+        self.assertEqual(cache.get(('questions', 2), 'all', lambda: ["reloaded"]), ["reloaded"])
+        self.assertEqual(cache.metrics()['cached_results'], 2)
+        self.assertEqual(cache.metrics()['evictions'], 2)
+        pass
+
+    def test_success_cache_pages_before_the_first_as_the_first(self):
+        """Page numbers below 1 should be served from the cache entry of the first page"""
+
+        for page in (1, 0, -1, -2):
+            response_object = self.app.test_client().get(f'/v1/questions?page={page}')
+            self.assertEqual(response_object.status_code, 200)
+
+        metrics = self.app.extensions['trivia_query_cache'].metrics()
+
+        # The first page and the categories.
+        self.assertEqual(metrics['cached_results'], 2)
+        pass
+
+    def test_success_discard_result_loaded_during_invalidation(self):
+        """A result loaded while its scope is invalidated should not be cached"""
+
+        cache = self.app.extensions['trivia_query_cache']
+
+        def load():
+            cache.invalidate('questions', 1)
+            return ["stale"]
+
+        cache.get(('questions', 1), 'all', load)
+        fresh_result = cache.get(('questions', 1), 'all', lambda: ["fresh"])
+
+        self.assertEqual(fresh_result, ["fresh"])
+        pass
+
+
+class DifficultyQuizTestCase(SQLiteTestCase):
+    """This class represents the trivia test case for difficulty-targeted quiz questions"""
+
+    def setUp(self):
+        """Create a SQLite database with one category holding three questions each of difficulty 1, 2 and 3."""
+        super().setUp()
+        self.config = {
+            "DIFFICULTY_SAMPLER_ENABLED": True,
+            "DIFFICULTY_SAMPLER_SYNC_INTERVAL": 60
+        }
+
+        with self.create_test_app(self.config).app_context():
+            db.session.add(Category(type="Science"))
+
+            for difficulty in (1, 2, 3):
+                for number in range(3):
+                    db.session.add(Question(question=f"Question {number} of difficulty {difficulty}",
+                                            answer="Answer", category=1, difficulty=difficulty))
+            db.session.commit()
+
+        self.app = self.create_test_app(self.config)
+        self.client = self.app.test_client
+
+    def draw(self, previous_questions=[], **difficulty):
+        response_object = self.client().post('/v1/quizzes', json=dict({"previous_questions": previous_questions,
+                                                                       "quiz_category": {"id": "1", "type": "Science"}}, **difficulty))
+
+        return response_object.status_code, json.loads(response_object.get_data())['question']
+
+    def test_success_get_quiz_question_of_target_difficulty(self):
+        """A target difficulty should be honoured until its questions run out, and then the nearest difficulty used"""
+
+        previous_questions = []
+
+        for number in range(3):
+            status_code, question = self.draw(previous_questions, difficulty=1)
+            previous_questions.append(question['id'])
+
+            self.assertEqual(status_code, 200)
+            self.assertEqual(question['difficulty'], 1)
+
+        status_code, question = self.draw(previous_questions, difficulty=1)
+
+        self.assertEqual(question['difficulty'], 2)
+        pass
+
+    def test_success_get_quiz_question_from_difficulty_distribution(self):
+        """Only difficulties with a positive weight should be drawn while they have questions left"""
+
+        difficulties = {self.draw(difficulty_distribution={"1": 0, "3": 2})[1]['difficulty']
+                        for attempt in range(20)}
+
+        self.assertEqual(difficulties, {3})
+        pass
+
+    def test_success_update_difficulty_pools_on_insert_and_delete(self):
+        """Added questions should be drawn right away, and deleted questions never again"""
+
+        self.client().post('/v1/questions', json={"question": "Which planet has rings?", "answer": "Saturn",
+                                                  "category": 1, "difficulty": 5})
+        status_code, added_question = self.draw(difficulty=5)
+
+        self.client().delete(f"/v1/questions/{added_question['id']}")
+        status_code, question = self.draw(difficulty=5)
+
+        self.assertEqual(added_question['question'], "Which planet has rings?")
+        self.assertEqual(question['difficulty'], 3)
+        pass
+
+    def test_success_sync_difficulty_pools_from_change_feed(self):
+        """A question added through another server process should be drawn after the next sync"""
+
+        other_app = self.create_test_app(self.config)
+        other_app.test_client().post('/v1/questions', json={"question": "Which planet has rings?", "answer": "Saturn",
+                                                            "category": 1, "difficulty": 5})
+
+        applied_changes = self.app.extensions['trivia_difficulty_sampler'].sync()
+        status_code, question = self.draw(difficulty=5)
+
+        self.assertEqual(applied_changes, 1)
+        self.assertEqual(question['question'], "Which planet has rings?")
+        pass
+
+    def test_400_get_quiz_question_with_difficulty_and_distribution(self):
+        """Requesting both a difficulty and a difficulty distribution should return a 400 status code"""
+
+        response_object = self.client().post('/v1/quizzes', json={"previous_questions": [], "quiz_category": {"id": "1", "type": "Science"},
+                                                                  "difficulty": 1, "difficulty_distribution": {"1": 1}})
+
+        self.assertEqual(response_object.status_code, 400)
+        pass
+
+    def test_400_get_quiz_question_of_non_numeric_category(self):
+        """Requesting a difficulty for a category with a non-numeric id should return a 400 status code"""
+
+        response_object = self.client().post('/v1/quizzes', json={"previous_questions": [], "quiz_category": {"id": "Science", "type": "Science"},
+                                                                  "difficulty": 1})
+
+        self.assertEqual(response_object.status_code, 400)
+        pass
+
+    def test_success_load_questions_without_category_or_difficulty(self):
+        """A question without a difficulty should count as difficulty 0, and a question without a category should be left out"""
+
+        with self.app.app_context():
+            db.session.add(Question(question="Which planet has rings?", answer="Saturn",
+                                    category=1, difficulty=None))
+            db.session.add(Question(question="Which planet is the largest?", answer="Jupiter",
+                                    category=None, difficulty=2))
+            db.session.commit()
+
+        difficulty_sampler = self.app.extensions['trivia_difficulty_sampler']
+        difficulty_sampler.refresh()
+        status_code, question = self.draw(difficulty=0)
+
+        self.assertEqual(question['question'], "Which planet has rings?")
+        self.assertEqual(difficulty_sampler.metrics()['pools'][1], {0: 1, 1: 3, 2: 3, 3: 3})
+        pass
+
+    def test_success_alias_table_follows_weights(self):
+        """The alias table should draw outcomes in proportion to their weights"""
+
+        rng = random.Random(7)
+        alias_table = AliasTable({1: 1, 2: 3})
+        draws = [alias_table.draw(rng) for attempt in range(4000)]
+
+        self.assertAlmostEqual(draws.count(2) / len(draws), 0.75, delta=0.03)
+        pass
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -16,7 +16,9 @@ class QuizView extends Component {
       numCorrect: 0,
       currentQuestion: {},
       guess: "",
-      forceEnd: false
+      forceEnd: false,
+      playerName: "",
+      scoreSubmitted: false
     };
   }
 
@@ -93,6 +95,31 @@ class QuizView extends Component {
     });
   };
 
+  submitScore = event => {
+    event.preventDefault();
+    $.ajax({
+      url: "https://full-stack-trivia.herokuapp.com/v1/quizzes/results", //TODO: update request URL
+      type: "POST",
+      dataType: "json",
+      contentType: "application/json",
+      data: JSON.stringify({
+        player: this.state.playerName,
+        quiz_category: parseInt(this.state.quizCategory.id, 10),
+        score: this.state.numCorrect,
+        total_questions: this.state.previousQuestions.length
+      }),
+      crossDomain: true,
+      success: result => {
+        this.setState({ scoreSubmitted: true });
+        return;
+      },
+      error: error => {
+        alert("Unable to submit score. Please try your request again");
+        return;
+      }
+    });
+  };
+
   restartGame = () => {
     this.setState({
       quizCategory: null,
@@ -101,7 +128,8 @@ class QuizView extends Component {
       numCorrect: 0,
       currentQuestion: {},
       guess: "",
-      forceEnd: false
+      forceEnd: false,
+      scoreSubmitted: false
     });
   };
 
@@ -139,6 +167,23 @@ class QuizView extends Component {
           {" "}
           Your Final Score is {this.state.numCorrect}
         </div>
+        {this.state.scoreSubmitted ||
+        this.state.previousQuestions.length === 0 ? null : (
+          <form onSubmit={this.submitScore}>
+            <input
+              type="text"
+              name="playerName"
+              placeholder="Your name"
+              value={this.state.playerName}
+              onChange={this.handleChange}
+            />
+            <input
+              className="submit-score button"
+              type="submit"
+              value="Submit Score"
+            />
+          </form>
+        )}
         <div className="play-again button" onClick={this.restartGame}>
           {" "}
           Play Again?{" "}